@@ -0,0 +1,3 @@
+# SPRE NFO Daemon benchmarks
+# corpus.py builds repeatable test NFOs/SFVs, micro.py times the render pipeline in process and load.py drives a
+# running daemon over HTTP(S). Every run prints (or writes) a JSON document so results can be diffed between changes.
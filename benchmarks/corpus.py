@@ -0,0 +1,87 @@
+# Repeatable CP437 test corpus. The same seed always gives the same bytes, so runs on different machines or
+# commits render exactly the same documents.
+#
+#   python -m benchmarks.corpus --output corpus/      write every document to a directory
+import argparse
+import os
+import random
+import zlib
+
+SHADES = '░▒▓█'
+BLOCKS = '█▄▀▌▐■'
+WORDS = ('release', 'group', 'proudly', 'presents', 'another', 'quality', 'crack', 'keygen', 'install', 'notes',
+         'unrar', 'burn', 'mount', 'play', 'support', 'the', 'software', 'you', 'enjoy', 'buy', 'it', 'greets',
+         'to', 'all', 'our', 'friends', 'and', 'couriers', 'date', 'size', 'disks', 'format', 'protection')
+
+# kind -> (lines, art width, text lines between art blocks)
+NFO_KINDS = {
+    'small': (24, 64, 6),
+    'ansi': (120, 78, 2),
+    'wide': (80, 320, 4),
+    'tall': (4000, 78, 10),
+}
+
+def art_line(rng, width):
+    # Runs of shading and block characters, the bulk of a typical group logo
+    line = []
+    while len(line) < width:
+        line.extend(rng.choice(SHADES + BLOCKS + ' ') * rng.randint(1, 6))
+    return ''.join(line[:width])
+
+def ansi_line(rng, width):
+    # Logo lines from ANSI editors keep some of their escape sequences when they're saved as NFO
+    line = art_line(rng, width)
+    cut = rng.randint(0, len(line))
+    return line[:cut] + f"\x1b[{rng.choice((0, 1))};{rng.randint(30, 37)}m" + line[cut:]
+
+def text_line(rng, width):
+    words = []
+    length = 0
+    while True:
+        word = rng.choice(WORDS)
+        if length + len(word) + 1 > width - 4:
+            break
+        words.append(word)
+        length += len(word) + 1
+    return f"║ {' '.join(words).ljust(width - 4)} ║"
+
+def generate_nfo(kind, rng):
+    lines_total, width, text_every = NFO_KINDS[kind]
+    lines = ['╔' + '═' * (width - 2) + '╗']
+    while len(lines) < lines_total - 1:
+        if kind == 'ansi' and rng.random() < 0.3:
+            lines.append(ansi_line(rng, width))
+        elif len(lines) % (text_every + 1) == 0:
+            lines.append(text_line(rng, width))
+        else:
+            lines.append(art_line(rng, width))
+    lines.append('╚' + '═' * (width - 2) + '╝')
+    return ('\r\n'.join(lines) + '\r\n').encode('cp437')
+
+def generate_sfv(rng, files=50, name='release'):
+    lines = ['; Generated by a benchmark corpus', '; ' + '-' * 40]
+    for i in range(files):
+        filename = f"{name}.r{i:02d}" if i else f"{name}.rar"
+        lines.append(f"{filename} {zlib.crc32(filename.encode()) ^ rng.getrandbits(32):08x}")
+    return ('\r\n'.join(lines) + '\r\n').encode('cp437')
+
+def build_corpus(seed=1):
+    # name -> bytes. Every NFO kind plus a small and a large SFV
+    rng = random.Random(seed)
+    corpus = {f"{kind}.nfo": generate_nfo(kind, rng) for kind in NFO_KINDS}
+    corpus['small.sfv'] = generate_sfv(rng, files=20)
+    corpus['large.sfv'] = generate_sfv(rng, files=500)
+    return corpus
+
+def write_corpus(path, seed=1):
+    os.makedirs(path, exist_ok=True)
+    for name, data in build_corpus(seed).items():
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(data)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the benchmark corpus to a directory')
+    parser.add_argument('--output', default='corpus')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    write_corpus(args.output, args.seed)
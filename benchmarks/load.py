@@ -0,0 +1,187 @@
+# End to end load driver for a running daemon. Every iteration is what a release announcement causes: an upload
+# (NFO plus SFV, save enabled), then a viewer hit, the NFO download and the SFV download. Each thread keeps one
+# keep-alive connection. The results give throughput and latency percentiles per endpoint.
+#
+#   python -m benchmarks.load --url https://127.0.0.1:6789 --insecure --concurrency 8 --duration 30
+import argparse
+import base64
+import http.client
+import json
+import random
+import re
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+from benchmarks.corpus import build_corpus
+from benchmarks.results import environment, summarize, write_results
+
+ENDPOINTS = ('upload_nfo', 'viewer', 'download', 'download_sfv')
+DEFAULT_MIX = 'small=5,ansi=3,wide=1,tall=1'
+
+class Client:
+    def __init__(self, base_url, insecure=False, timeout=60):
+        parts = urlsplit(base_url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.context = ssl._create_unverified_context() if insecure else None
+        self.timeout = timeout
+        self.connection = None
+
+    def connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self.context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        # One retry on a fresh connection, the server may have closed an idle keep-alive one
+        for attempt in (0, 1):
+            if self.connection is None:
+                self.connection = self.connect()
+            try:
+                self.connection.request(method, path, body=body, headers=headers or {})
+                response = self.connection.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, OSError):
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        weights[f"{kind.strip()}.nfo"] = int(weight or 1)
+    return weights
+
+class LoadRun:
+    def __init__(self, args):
+        self.args = args
+        self.corpus = build_corpus(args.seed)
+        self.mix = parse_mix(args.mix)
+        self.lock = threading.Lock()
+        self.samples = {endpoint: [] for endpoint in ENDPOINTS}
+        self.statuses = {endpoint: {} for endpoint in ENDPOINTS}
+        self.iterations = 0
+
+    def record(self, endpoint, seconds, status):
+        with self.lock:
+            self.samples[endpoint].append(seconds)
+            self.statuses[endpoint][status] = self.statuses[endpoint].get(status, 0) + 1
+
+    def timed(self, client, endpoint, method, path, body=None, headers=None):
+        started = time.perf_counter()
+        try:
+            status, data = client.request(method, path, body, headers)
+        except (http.client.HTTPException, OSError):
+            status, data = 'connection_error', b''
+        self.record(endpoint, time.perf_counter() - started, status)
+        return status, data
+
+    def payload(self, rng):
+        names = list(self.mix)
+        name = rng.choices(names, weights=[self.mix[n] for n in names])[0]
+        nfo = self.corpus[name]
+        if self.args.unique:
+            # A different last line per upload, so every upload misses the render cache
+            nfo += f"{rng.getrandbits(64):016x}\r\n".encode()
+        return {
+            'nfo_data': base64.b64encode(nfo).decode(),
+            'release': f"Benchmark.{name[:-4]}-BENCH",
+            'filename': name,
+            'save': True,
+            'date': '2005-05-28 17:58:07',
+            'files': 20,
+            'size': 700,
+            'sfvs': [{'sfv_data': base64.b64encode(self.corpus['small.sfv']).decode(), 'sfvname': 'bench.sfv', 'sfvpath': 'CD1'}]
+        }
+
+    def iteration(self, client, rng):
+        body = json.dumps(self.payload(rng))
+        headers = {'Authorization': self.args.token, 'Content-Type': 'application/json'}
+        status, data = self.timed(client, 'upload_nfo', 'POST', '/upload_nfo', body, headers)
+        if status != 200:
+            return
+        viewer_url = json.loads(data)['url']
+        hexdig = viewer_url.rsplit('/', 1)[-1]
+        status, page = self.timed(client, 'viewer', 'GET', viewer_url)
+        self.timed(client, 'download', 'GET', f"/download/{hexdig}")
+        match = re.search(rb'/download_sfv/([0-9a-f]+)', page)
+        if match:
+            self.timed(client, 'download_sfv', 'GET', f"/download_sfv/{match.group(1).decode()}")
+
+    def worker(self, index, deadline):
+        client = Client(self.args.url, self.args.insecure, self.args.timeout)
+        rng = random.Random(self.args.seed * 1000 + index)
+        while time.perf_counter() < deadline:
+            with self.lock:
+                if self.args.iterations and self.iterations >= self.args.iterations:
+                    return
+                self.iterations += 1
+            self.iteration(client, rng)
+
+    def run(self):
+        started = time.perf_counter()
+        deadline = started + self.args.duration
+        threads = [threading.Thread(target=self.worker, args=(i, deadline)) for i in range(self.args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        endpoints = {}
+        for endpoint in ENDPOINTS:
+            endpoints[endpoint] = dict(
+                summarize(self.samples[endpoint]),
+                per_second=len(self.samples[endpoint]) / elapsed,
+                statuses={str(status): count for status, count in self.statuses[endpoint].items()}
+            )
+        total = sum(len(samples) for samples in self.samples.values())
+        return {
+            'benchmark': 'load',
+            'environment': environment(),
+            'settings': {
+                'url': self.args.url,
+                'concurrency': self.args.concurrency,
+                'duration': self.args.duration,
+                'iterations': self.args.iterations,
+                'mix': self.mix,
+                'unique': self.args.unique,
+                'seed': self.args.seed
+            },
+            'elapsed_seconds': elapsed,
+            'iterations': self.iterations,
+            'requests': total,
+            'requests_per_second': total / elapsed,
+            'endpoints': endpoints
+        }
+
+def read_token(path='tokens.txt'):
+    try:
+        with open(path, 'r') as f:
+            return next((line.strip() for line in f if line.strip()), None)
+    except OSError:
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive uploads, viewer hits and downloads against a running daemon')
+    parser.add_argument('--url', default='https://127.0.0.1:6789', help='Daemon base URL')
+    parser.add_argument('--token', default=None, help='Upload token, defaults to the first one in tokens.txt')
+    parser.add_argument('--insecure', action='store_true', help="Don't verify the TLS certificate (it won't match 127.0.0.1)")
+    parser.add_argument('--concurrency', type=int, default=4, help='Client threads, each with its own connection')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to run for')
+    parser.add_argument('--iterations', type=int, default=0, help='Stop after this many upload/view/download rounds (0 for no limit)')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"Corpus NFOs to upload and their weights (default {DEFAULT_MIX})")
+    parser.add_argument('--unique', action='store_true', help='Make every NFO different so none of them hit the render cache')
+    parser.add_argument('--seed', type=int, default=1, help='Corpus and request mix seed')
+    parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait on a single request')
+    parser.add_argument('--output', help='Write the JSON results here instead of printing them')
+    args = parser.parse_args()
+    args.token = args.token or read_token()
+    if not args.token:
+        parser.error('no token given and none found in tokens.txt')
+    write_results(LoadRun(args).run(), args.output)
@@ -0,0 +1,62 @@
+# Microbenchmarks for the render pipeline, run in process against main.py with its current settings.
+# Run from the repository root so the fonts are found:
+#
+#   python -m benchmarks.micro [--repeat 20] [--seed 1] [--output micro.json]
+import argparse
+import base64
+import time
+
+import main
+from benchmarks.corpus import build_corpus
+from benchmarks.results import environment, summarize, write_results
+
+def time_calls(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+def benchmark_document(data, repeat):
+    # Each stage gets the previous stage's output, the same way an upload goes through them.
+    # Lines are clipped first like render_png does, so tall documents cost what they cost the daemon.
+    encoded = base64.b64encode(data)
+    lines = main.clip_nfo_lines(main.read_nfo_from_base64(encoded))
+    image = main.render_nfo_to_image(lines)
+    png = main.encode_png(image)
+    return {
+        'bytes': len(data),
+        'lines': len(lines),
+        'image': f"{image.width}x{image.height}",
+        'png_bytes': len(png),
+        'read_nfo_from_base64': summarize(time_calls(lambda: main.read_nfo_from_base64(encoded), repeat)),
+        'render_nfo_to_image': summarize(time_calls(lambda: main.render_nfo_to_image(lines), repeat)),
+        'encode_png': summarize(time_calls(lambda: main.encode_png(image), repeat))
+    }
+
+def run(repeat=20, seed=1):
+    # Load the font and atlas up front so the first render isn't paying for them
+    main.render_nfo_to_image(main.read_nfo_from_bytes(b' '))
+    return {
+        'benchmark': 'micro',
+        'environment': environment(),
+        'settings': {
+            'repeat': repeat,
+            'seed': seed,
+            'use_glyph_atlas': main.use_glyph_atlas,
+            'nfo_ansi_mode': main.nfo_ansi_mode,
+            'png_palette_mode': main.png_palette_mode,
+            'png_compress_level': main.png_compress_level,
+            'max_render_pixels': main.max_render_pixels
+        },
+        'documents': {name: benchmark_document(data, repeat) for name, data in build_corpus(seed).items()}
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time base64 decoding, rendering and PNG encoding of the benchmark corpus')
+    parser.add_argument('--repeat', type=int, default=20, help='Calls timed per stage and document')
+    parser.add_argument('--seed', type=int, default=1, help='Corpus seed')
+    parser.add_argument('--output', help='Write the JSON results here instead of printing them')
+    args = parser.parse_args()
+    write_results(run(args.repeat, args.seed), args.output)
@@ -0,0 +1,52 @@
+# Shared bits for benchmark output: latency summaries and the environment a run was made in
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+def percentile(sorted_samples, fraction):
+    # Nearest rank on an already sorted list
+    if not sorted_samples:
+        return None
+    index = min(len(sorted_samples) - 1, max(0, round(fraction * len(sorted_samples)) - 1))
+    return sorted_samples[index]
+
+def summarize(samples):
+    # Seconds in, milliseconds out
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'min_ms': samples[0] * 1000,
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p90_ms': percentile(samples, 0.90) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'max_ms': samples[-1] * 1000
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    return {
+        'timestamp': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+def write_results(results, output=None):
+    data = json.dumps(results, indent=2)
+    if output is None:
+        print(data)
+    else:
+        with open(output, 'w') as f:
+            f.write(data + '\n')
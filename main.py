@@ -3,15 +3,35 @@
 
 import os
 import base64
+import gzip
 import hashlib
+import heapq
+import hmac
+import json
+import logging
+import math
+import re
+import signal
 import threading
 import time
-from flask import Flask, request, send_file, send_from_directory, render_template_string, jsonify, url_for
-from PIL import Image, ImageDraw, ImageFont
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from flask import Flask, request, g, has_request_context, copy_current_request_context, send_file, send_from_directory, jsonify, url_for
+from werkzeug.exceptions import RequestEntityTooLarge
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+import numpy as np
 from io import BytesIO
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timezone
 
-app = Flask(__name__)
+# Renders are served from the artifact store by serve_render, not Flask's static folder
+app = Flask(__name__, static_folder=None)
 
 # make sure static and fonts directories exist
 os.makedirs('static', exist_ok=True)
@@ -24,200 +44,1858 @@ timeout_seconds = 300                  # NFO timeout, how long before the files
 server_port = 6789                     # Set the server port
 debug_mode = False                      # Debug Mode, dont forget to disable this once you are happy it works!
 host_ip = '0.0.0.0'                    # Set the host IP interface. 0.0.0.0 for all
+server_mode = 'development'            # 'development' runs Flask's built in server. 'production' runs gunicorn (pip install gunicorn) with the settings below
+server_workers = 4                     # Production only. Worker processes handling requests
+server_threads = 8                     # Production only. Threads per worker process
+server_keepalive = 5                   # Production only. Seconds to hold idle keep-alive connections open
 
 #-NFO Render settings
 font_path = "fonts/cp437_IBM_VGA8.ttf" # Font to render NFOs. I find this is the best one to get a decent clean render
 font_size = 16                         # 16 is the perfect size to render cp437_IBM_VGA8.
 font_color = "white"                   # Font colour to render
 background_color = "black"             # Background colour to render. Note, you should also adjust the HTML color scheme if you change this
+use_glyph_atlas = True                 # Render NFOs from a pre-rasterized CP437 glyph atlas. Falls back to per-line FreeType rendering if the font isn't suitable
+nfo_ansi_mode = False                  # Render ANSI colour escapes in colour (needs the glyph atlas) instead of drawing them as characters, and drop SAUCE records
+
+#-Render variant settings
+render_variants = True                 # Let /static/<hash>.png take ?font=, ?scale=, ?invert=1 and ?width= and render that variant on demand. Keeps each NFO's text next to its PNG
+variant_fonts = {                      # Fonts ?font= can ask for, name -> (font file, size). Leaving font out uses font_path/font_size
+    'itt': ("fonts/nfo_alternative_fonts/Px437_ITT_Xtra-2y.ttf", 16),
+}
+variant_max_scale = 3                  # Largest ?scale=. Renders are enlarged pixel for pixel
+variant_widths = (160, 320, 480, 640, 800) # Thumbnail widths ?width= accepts. Renders wider than that are shrunk to fit
+variant_cache_bytes = 32 * 1024 * 1024 # Rendered variants are kept in memory and the least recently used dropped past this many bytes. Per process in production mode
+
+#-Upload settings
+max_upload_bytes = 16 * 1024 * 1024    # Largest request body accepted, anything bigger is rejected with a 413
+upload_chunk_size = 64 * 1024          # Raw uploads are read and hashed in chunks of this size
+
+#-Async upload settings
+async_uploads = False                  # Reply with the viewer URL straight away and render in the background. Uploads can also ask for this with "async": true
+async_workers = 4                      # Background threads rendering async uploads
+async_queue_limit = 256                # Most async uploads waiting to render before new ones are turned away with a 503
+
+#-Render executor settings
+render_processes = 0                   # Worker processes to render in, so uploads use more than one core. 0 renders in the request thread. Needs a platform with fork (Linux)
+render_queue_limit = 64                # Most renders queued for the worker processes before uploads are turned away with a 503
+render_timeout = 30                    # Seconds to wait on a render before the upload fails
+
+#-Admission control settings
+max_concurrent_uploads = 4             # Uploads rendering at once, per process. Viewer and image requests never wait on this. 0 for no limit
+upload_wait_queue = 2                  # Uploads that can wait for a free slot, any more get a 503 straight away. Keep this plus max_concurrent_uploads under server_threads in production
+upload_wait_seconds = 2                # Longest an upload waits for a slot before it gets a 503
+busy_retry_seconds = 5                 # Retry-After sent with 503 Busy responses
+view_renders = 2                       # Renders started by viewers (tiled strips, text mode PNGs, image variants) running at once, per process. Kept apart from the upload slots. 0 for no limit
+view_render_wait_queue = 2             # Viewer renders that can wait for a free slot, any more get a 503 straight away
+view_render_wait_seconds = 2           # Longest a viewer render waits for a slot before it gets a 503
+max_nfo_lines = 20000                  # NFOs/SFVs with more lines than this are rejected with a 413 before anything is rendered. 0 for no limit
+max_render_width = 8000                # NFOs/SFVs that would render wider than this many pixels are rejected with a 413. 0 for no limit
+
+#-SFV settings
+sfv_render_mode = 'table'              # 'table' shows SFV entries as an HTML table and only renders their comment art. 'image' renders the whole SFV like an NFO
+
+#-Text mode settings
+render_mode = 'image'                  # 'image' renders every NFO to PNG on upload. 'text' sends the NFO text to the browser in the CP437 web font and only renders a PNG if someone asks for one
+
+#-Tiled rendering settings
+tile_lines = 200                       # NFOs with more lines than this are cut into strips of this many lines, each rendered when it's first viewed. 0 always renders one image
+max_render_pixels = 40000000           # Renders are cut short at this many pixels (width x height), however many lines the NFO has
+
+#-PNG encoding settings
+png_compress_level = 6                 # zlib level used for rendered PNGs, 0-9. Lower is faster to encode, higher gives smaller files
+png_palette_mode = True                # Save renders as palette PNGs. Two colour renders (the normal case) are stored as 1-bit, which is much smaller than RGB
 
 TOKEN_FILE = 'tokens.txt'              # Access tokens for REST API Access
+token_reload_seconds = 5               # How often tokens.txt is checked for changes. 0 only reloads it on SIGHUP
+token_rate_limit = 0                   # Requests per second each token can make on average, 0 for no limit. Counted per process in production mode
+token_rate_burst = 20                  # Requests a token can make in a burst before token_rate_limit applies
+
+#-Metrics settings
+log_request_timings = False            # Log a JSON line per request with its route, status, duration and stage timings. /metrics is always available
+
+#-Static file settings
+render_max_age = 31536000              # Seconds browsers may cache renders and downloads for. They're named by content hash so they never change
+asset_max_age = 86400                  # Seconds browsers may cache fonts and the favicon for, after that they revalidate with the ETag
+precompress_downloads = False          # Keep a gzip copy of downloadable NFOs/SFVs and send it to clients that accept gzip
+static_offload = None                  # None sends files from Python. 'x-accel' (nginx) or 'x-sendfile' (Apache/lighttpd) hands files in static/ to the reverse proxy. Filesystem storage only
+static_offload_prefix = '/protected-static/' # x-accel only. The internal nginx location that serves static/
+
+#-Batch upload settings
+batch_workers = 4                      # Worker threads rendering /upload_nfo_batch items in parallel
+batch_max_uploads = 50                 # Most uploads accepted in one batch request
+
+#-Storage settings
+storage_backend = 'filesystem'         # 'filesystem' keeps uploads as files in static/, 'memory' keeps them in RAM (lost on restart)
+memory_store_max_bytes = 256 * 1024 * 1024 # Memory backend only. Oldest uploads are expired early once the store holds more than this
+
+#-Expiry settings
+UPLOAD_INDEX = 'static/upload_index.jsonl' # Every stored upload and its expiry deadline, so NFOs are still served and still expire if the daemon is restarted
+UPLOAD_INDEX_LOCK = 'static/upload_index.lock' # Production only. Lets the worker processes and the master share the index
+LEGACY_EXPIRY_JOURNAL = 'static/expiry_queue.txt' # Where older versions kept pending deletions, read once to import their uploads
+expiry_retry_seconds = 30              # An upload that fails to expire (a file that can't be deleted, say) is tried again after this long
+sweep_orphans_on_startup = True        # Sweep static/ in the background at startup, deleting anything no upload in the index owns. Disable to keep old renders around for testing
 
 #-Lets Encrypt certificates (make sure these are accessible by the daemon user)
 le_fullchain = "fullchain.pem"         # SSL fullchain pem
 le_privkey = "privkey.pem"             # SSL privkey pem
 #----------------------------------------------------------------------------------------------------
 
+app.config['MAX_CONTENT_LENGTH'] = max_upload_bytes
+
+worker_process = False                 # Set in production worker processes, which serve requests but leave expiry to the master
+
+#----------------------
+#-Tokens
+# tokens.txt is re-read off the request path, by a watcher thread when it changes or on SIGHUP, and the new set
+# replaces the old one in a single assignment so a request always sees one version or the other. Each token gets
+# request/byte counters (shown on /metrics by a short hash, never the token itself) and an optional token bucket.
 VALID_TOKENS = set()
+token_file_stamp = None
+token_stats = {}                       # token -> {'requests', 'bytes', 'limited'}
+token_buckets = {}                     # token -> (tokens left, last refill)
+token_lock = threading.Lock()
 
 def load_tokens():
-    global VALID_TOKENS
+    global VALID_TOKENS, token_file_stamp
+    tokens = set()
+    stamp = None
     if os.path.exists(TOKEN_FILE):
+        stamp = (os.stat(TOKEN_FILE).st_mtime_ns, os.stat(TOKEN_FILE).st_size)
         with open(TOKEN_FILE, 'r') as file:
-            VALID_TOKENS = set(line.strip() for line in file)
+            tokens = set(line.strip() for line in file if line.strip())
+    VALID_TOKENS = tokens
+    token_file_stamp = stamp
+    with token_lock:
+        # Revoked tokens lose their counters and buckets
+        for table in (token_stats, token_buckets):
+            for token in [token for token in table if token not in tokens]:
+                del table[token]
+
+def watch_token_file():
+    while True:
+        time.sleep(token_reload_seconds)
+        try:
+            stamp = (os.stat(TOKEN_FILE).st_mtime_ns, os.stat(TOKEN_FILE).st_size) if os.path.exists(TOKEN_FILE) else None
+            if stamp != token_file_stamp:
+                load_tokens()
+        except OSError:
+            pass
+
+def start_token_watcher():
+    if token_reload_seconds > 0:
+        threading.Thread(target=watch_token_file, name='token-watcher', daemon=True).start()
+
+def reload_tokens_on_signal(signum, frame):
+    load_tokens()
+
+def check_token(header):
+    # Returns the matching token, or None. Every token is compared in constant time so timing doesn't leak a prefix
+    if not header:
+        return None
+    header = header.strip()
+    if header[:7].lower() == 'bearer ':
+        header = header[7:].strip()
+    candidate = header.encode()
+    match = None
+    for token in VALID_TOKENS:
+        if hmac.compare_digest(candidate, token.encode()):
+            match = token
+    return match
+
+def token_id(token):
+    return hashlib.sha256(token.encode()).hexdigest()[:8]
+
+def take_token_request(token, size):
+    # Count the request against the token. Returns how many seconds to wait when its bucket is empty, else 0
+    now = time.monotonic()
+    with token_lock:
+        stats = token_stats.setdefault(token, {'requests': 0, 'bytes': 0, 'limited': 0})
+        stats['requests'] += 1
+        stats['bytes'] += size
+        if token_rate_limit <= 0:
+            return 0
+        left, updated = token_buckets.get(token, (token_rate_burst, now))
+        left = min(token_rate_burst, left + (now - updated) * token_rate_limit)
+        if left < 1:
+            token_buckets[token] = (left, now)
+            stats['limited'] += 1
+            return (1 - left) / token_rate_limit
+        token_buckets[token] = (left - 1, now)
+        return 0
 
 def token_required(f):
+    @wraps(f)
     def decorated_function(*args, **kwargs):
-        token = request.headers.get('Authorization')
-        if not token or token not in VALID_TOKENS:
+        token = check_token(request.headers.get('Authorization'))
+        if token is None:
             return jsonify({"message": "Unauthorized"}), 401
+        retry_after = take_token_request(token, request.content_length or 0)
+        if retry_after:
+            response = jsonify({"message": "Too many requests"})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(math.ceil(retry_after))
+            return response
         return f(*args, **kwargs)
     return decorated_function
 
 load_tokens()
 
+#----------------------
+#-NFO decoding
+# An NFO is read once into what the renderers need: the CP437 bytes of every line, which the glyph atlas indexes with
+# directly, and the widest line in columns. With nfo_ansi_mode on, SAUCE records are dropped and ANSI escapes are
+# taken out of the lines as they're split, leaving a foreground and background palette index for every character.
+ANSI_ESCAPE = re.compile(rb'\x1b\[([0-9;]*)([A-Za-z])')
+ANSI_PALETTE = (
+    '#000000', '#aa0000', '#00aa00', '#aa5500', '#0000aa', '#aa00aa', '#00aaaa', '#aaaaaa',
+    '#555555', '#ff5555', '#55ff55', '#ffff55', '#5555ff', '#ff55ff', '#55ffff', '#ffffff'
+)
+ANSI_DEFAULT_BACKGROUND = 0            # Palette index 0 is background_color and 1 is font_color, the ANSI colours follow
+ANSI_DEFAULT_FOREGROUND = 1
+ANSI_MAX_CURSOR_FORWARD = 255          # Cursor forward escapes become this many spaces at most
+
+class NfoLines:
+    __slots__ = ('rows', 'columns', 'colors')
+
+    def __init__(self, rows, colors=None):
+        self.rows = rows
+        self.columns = max(map(len, rows), default=0)
+        self.colors = colors           # None, or a (foreground, background) pair of palette index bytes per row
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, index):
+        # Clipping and strips take slices, those stay NfoLines
+        if isinstance(index, slice):
+            return NfoLines(self.rows[index], None if self.colors is None else self.colors[index])
+        return self.rows[index]
+
+    def text(self):
+        # FreeType and the browser want characters, not CP437 bytes
+        return [row.decode('cp437') for row in self.rows]
+
 def read_nfo_from_base64(base64_data):
-    decoded_data = base64.b64decode(base64_data).decode('cp437')
-    return decoded_data.splitlines()
+    return read_nfo_from_bytes(base64.b64decode(base64_data))
+
+def read_nfo_from_bytes(data):
+    # bytes.splitlines only breaks on CR and LF, the other control bytes are glyphs in CP437
+    if not nfo_ansi_mode:
+        return NfoLines(data.splitlines())
+    data = strip_sauce(data)
+    if b'\x1b' not in data:
+        return NfoLines(data.splitlines())
+    return read_ansi_lines(data)
+
+def strip_sauce(data):
+    # SAUCE is a 128 byte record at the very end, optionally after a block of 64 byte comment lines, and usually
+    # has an EOF byte in front of it
+    if len(data) >= 128 and data[-128:-121] == b'SAUCE00':
+        end = len(data) - 128
+        comments = data[-24] * 64
+        if comments and data[end - comments - 5:end - comments] == b'COMNT':
+            end -= comments + 5
+        data = data[:end]
+    return data[:-1] if data.endswith(b'\x1a') else data
+
+def ansi_foreground(state):
+    color, bold, _ = state
+    if color is None:
+        return ANSI_DEFAULT_FOREGROUND
+    return 2 + (color + 8 if bold and color < 8 else color)
+
+def apply_sgr(state, params):
+    color, bold, background = state
+    for param in (params.split(b';') if params else [b'0']):
+        code = int(param or 0)
+        if code == 0:
+            color, bold, background = None, False, ANSI_DEFAULT_BACKGROUND
+        elif code == 1:
+            bold = True
+        elif code == 22:
+            bold = False
+        elif 30 <= code <= 37:
+            color = code - 30
+        elif code == 39:
+            color = None
+        elif 40 <= code <= 47:
+            background = 2 + code - 40
+        elif code == 49:
+            background = ANSI_DEFAULT_BACKGROUND
+        elif 90 <= code <= 97:
+            color = code - 90 + 8
+        elif 100 <= code <= 107:
+            background = 2 + code - 100 + 8
+    return color, bold, background
+
+def read_ansi_lines(data):
+    # Colours carry over from one line to the next. Only colour (m) and cursor forward (C) escapes mean anything
+    # without a terminal to move around in, the rest are dropped
+    rows = []
+    colors = []
+    state = (None, False, ANSI_DEFAULT_BACKGROUND)
+    for line in data.splitlines():
+        if b'\x1b' not in line:
+            rows.append(line)
+            colors.append((bytes([ansi_foreground(state)]) * len(line), bytes([state[2]]) * len(line)))
+            continue
+        row = bytearray()
+        foreground = bytearray()
+        background = bytearray()
+        position = 0
+        for match in ANSI_ESCAPE.finditer(line):
+            params, command = match.groups()
+            text = line[position:match.start()]
+            if command == b'C':
+                text += b' ' * min(int(params.split(b';')[0] or 1), ANSI_MAX_CURSOR_FORWARD)
+            row += text
+            foreground += bytes([ansi_foreground(state)]) * len(text)
+            background += bytes([state[2]]) * len(text)
+            if command == b'm':
+                state = apply_sgr(state, params)
+            position = match.end()
+        text = line[position:]
+        row += text
+        foreground += bytes([ansi_foreground(state)]) * len(text)
+        background += bytes([state[2]]) * len(text)
+        rows.append(bytes(row))
+        colors.append((bytes(foreground), bytes(background)))
+    return NfoLines(rows, colors)
+
+#----------------------
+#-Metrics
+# Request counts and per-stage timing histograms for /metrics (Prometheus text format). They're kept per process,
+# so in production mode each worker reports its own. Stages timed inside a request are also collected on g for
+# the per-request timing log.
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+metrics_lock = threading.Lock()
+stage_histograms = {}                  # stage -> cumulative bucket counts, count and sum
+route_requests = {}                    # (route, method, status) -> count
+render_cache_lookups = {'hit': 0, 'miss': 0}
+
+timing_log = logging.getLogger('nfodaemon.timing')
+timing_log.setLevel(logging.INFO)
+timing_log.addHandler(logging.StreamHandler())
+timing_log.propagate = False
+
+def observe_stage(stage, seconds):
+    with metrics_lock:
+        histogram = stage_histograms.get(stage)
+        if histogram is None:
+            histogram = stage_histograms[stage] = {'buckets': [0] * len(METRIC_BUCKETS), 'count': 0, 'sum': 0.0}
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+    # Batch and async workers run in a copied context without these, their stages only go to the histograms
+    if has_request_context() and 'stage_timings' in g:
+        g.stage_timings[stage] = g.stage_timings.get(stage, 0) + seconds
+
+@contextmanager
+def timed_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.stage_timings = {}
+
+@app.after_request
+def count_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    key = (route, request.method, response.status_code)
+    with metrics_lock:
+        route_requests[key] = route_requests.get(key, 0) + 1
+    if log_request_timings and 'request_started' in g:
+        timing_log.info(json.dumps({
+            'route': route,
+            'method': request.method,
+            'status': response.status_code,
+            'duration': round(time.perf_counter() - g.request_started, 6),
+            'stages': {stage: round(seconds, 6) for stage, seconds in g.stage_timings.items()}
+        }))
+    return response
+
+#----------------------
+#-Glyph atlas
+# CP437 only has 256 glyphs and the fonts we use are fixed width, so instead of running every line through
+# FreeType we rasterize each glyph once and build the NFO by indexing the atlas with the CP437 byte values.
+# The atlas is only used if the font renders as a clean bitmap (no anti-aliasing, one advance for every glyph,
+# nothing drawn past the advance), which keeps the output pixel-identical to the draw.text path.
+glyph_atlases = {}
+render_fonts = {}
+
+def get_render_font(render_font_path, render_font_size):
+    key = (render_font_path, render_font_size)
+    if key not in render_fonts:
+        render_fonts[key] = ImageFont.truetype(render_font_path, render_font_size)
+    return render_fonts[key]
+
+def build_glyph_atlas(atlas_font_path, atlas_font_size):
+    font = ImageFont.truetype(atlas_font_path, atlas_font_size)
+    chars = bytes(range(256)).decode('cp437')
+
+    advances = set(font.getlength(char) for char in chars)
+    if len(advances) != 1:
+        return None
+    advance = advances.pop()
+    if advance <= 0 or not float(advance).is_integer():
+        return None
+    advance = int(advance)
+    pitch = atlas_font_size
+
+    # Draw every glyph on a canvas with a line of margin above and below so we catch anything that
+    # spills into the neighbouring rows
+    canvas_width = advance * 3
+    canvas_height = pitch * 3
+    glyphs = np.zeros((257, canvas_height, advance), dtype=np.uint8)  # index 256 is a blank cell for padding
+    for code, char in enumerate(chars):
+        canvas = Image.new('L', (canvas_width, canvas_height), color=0)
+        ImageDraw.Draw(canvas).text((advance, pitch), char, font=font, fill=255)
+        pixels = np.asarray(canvas)
+        if np.any(pixels[:, :advance]) or np.any(pixels[:, advance * 2:]):
+            return None
+        if np.any((pixels != 0) & (pixels != 255)):
+            return None
+        glyphs[code] = pixels[:, advance:advance * 2]
+
+    # Split the glyph canvas into line-sized tiles, keeping only the rows that actually have ink.
+    # Tile offset is in lines relative to the line being drawn.
+    tiles = []
+    for offset in (-1, 0, 1):
+        tile = glyphs[:, (offset + 1) * pitch:(offset + 2) * pitch, :]
+        if offset == 0 or np.any(tile):
+            tiles.append((offset, np.ascontiguousarray(tile)))
+
+    return {'advance': advance, 'pitch': pitch, 'tiles': tiles}
+
+def get_glyph_atlas(atlas_font_path, atlas_font_size):
+    key = (atlas_font_path, atlas_font_size)
+    if key not in glyph_atlases:
+        glyph_atlases[key] = build_glyph_atlas(atlas_font_path, atlas_font_size)
+    return glyph_atlases[key]
 
-def render_nfo_to_image(lines):
-    font = ImageFont.truetype(font_path, font_size)
+def render_style(variant=None):
+    # Font, colours and scale a render is drawn with. No variant is the settings above
+    variant = variant or {}
+    path, size = variant_fonts[variant['font']] if variant.get('font') else (font_path, font_size)
+    foreground, background = (background_color, font_color) if variant.get('invert') else (font_color, background_color)
+    return {'font_path': path, 'font_size': size, 'font_color': foreground, 'background_color': background, 'scale': variant.get('scale', 1)}
+
+def render_nfo_with_atlas(lines, atlas, style):
+    padding = 20
+    advance = atlas['advance']
+    pitch = atlas['pitch']
+    rows = lines.rows
+    lengths = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+    columns = lines.columns
+    width = columns * advance + padding * 2
+    height = len(rows) * pitch + padding * 2
+
+    # Grid of glyph indexes, one row per line, padded out with the blank cell
+    codes = np.frombuffer(b''.join(row.ljust(columns, b' ') for row in rows), dtype=np.uint8)
+    codes = codes.reshape(len(rows), columns).astype(np.uint16)
+    codes[np.arange(columns) >= lengths[:, None]] = 256
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+    for offset, tile in atlas['tiles']:
+        block = tile[codes].transpose(0, 2, 1, 3).reshape(len(rows) * pitch, columns * advance)
+        top = padding + offset * pitch
+        src_top = max(0, -top)
+        src_bottom = min(block.shape[0], height - top)
+        target = mask[top + src_top:top + src_bottom, padding:padding + columns * advance]
+        np.maximum(target, block[src_top:src_bottom], out=target)
+
+    palette = ImageColor.getrgb(style['background_color']) + ImageColor.getrgb(style['font_color'])
+    if lines.colors is None:
+        # Only two colours in play, so hand back a palette image and let encode_png decide how to store it
+        image = Image.frombytes('P', (int(width), height), (mask & 1).tobytes())
+        image.putpalette(palette)
+        return image
+
+    # ANSI colours: every pixel takes its cell's foreground where there's ink and its background elsewhere
+    def cell_colors(which, default):
+        grid = np.frombuffer(b''.join(pair[which].ljust(columns, bytes([default])) for pair in lines.colors), dtype=np.uint8)
+        grid = np.repeat(np.repeat(grid.reshape(len(rows), columns), pitch, axis=0), advance, axis=1)
+        pixels = np.full((height, width), default, dtype=np.uint8)
+        pixels[padding:padding + len(rows) * pitch, padding:padding + columns * advance] = grid
+        return pixels
+    pixels = np.where(mask != 0, cell_colors(0, ANSI_DEFAULT_FOREGROUND), cell_colors(1, ANSI_DEFAULT_BACKGROUND))
+    image = Image.frombytes('P', (int(width), height), np.ascontiguousarray(pixels).tobytes())
+    image.putpalette(palette + tuple(channel for color in ANSI_PALETTE for channel in ImageColor.getrgb(color)))
+    return image
+
+def render_nfo_with_freetype(lines, style):
+    font = get_render_font(style['font_path'], style['font_size'])
+    lines = lines.text()
     
 # Time to calculate the size of the image
     padding = 20
     max_text_width = max(font.getbbox(line)[2] for line in lines)
     width = max_text_width + padding * 2
-    height = len(lines) * font_size + padding * 2
+    height = len(lines) * style['font_size'] + padding * 2
     
-    image = Image.new('RGB', (int(width), height), color=background_color)
+    image = Image.new('RGB', (int(width), height), color=style['background_color'])
     draw = ImageDraw.Draw(image)
     
     # Render the NFO text
     y = padding
     for line in lines:
-        draw.text((padding, y), line.strip('\r\n'), font=font, fill=font_color)
-        y += font_size
+        draw.text((padding, y), line, font=font, fill=style['font_color'])
+        y += style['font_size']
 
     return image
 
-def save_sfv_files(sfvs, hexdig):
-    saved_paths = []
-    for i, sfv in enumerate(sfvs):
-        sfv_data = sfv['sfv_data']
-        sfvname = sfv['sfvname']
-        sfvpath = sfv.get('sfvpath', '')
+def render_nfo_to_image(lines, style=None):
+    style = style or render_style()
+    if use_glyph_atlas:
+        atlas = get_glyph_atlas(style['font_path'], style['font_size'])
+        if atlas is not None:
+            return render_nfo_with_atlas(lines, atlas, style)
+    return render_nfo_with_freetype(lines, style)
 
-        sfv_lines = read_nfo_from_base64(sfv_data)
-        sfv_image = render_nfo_to_image(sfv_lines)
+#----------------------
+#-Tiled rendering
+# Tall NFOs aren't rendered as one huge bitmap. The source is kept instead and cut into strips of tile_lines lines
+# that are rendered (and cached) one at a time when the viewer asks for them. Stacked, the strips are exactly the
+# full image. Renders are also clipped to max_render_pixels so one silly NFO can't eat all the memory.
+def nfo_image_width(lines, style=None):
+    # Same width render_nfo_to_image would come up with, without drawing anything. Atlas fonts are fixed width, so
+    # that's just the column count
+    style = style or render_style()
+    padding = 20
+    if use_glyph_atlas:
+        atlas = get_glyph_atlas(style['font_path'], style['font_size'])
+        if atlas is not None:
+            return lines.columns * atlas['advance'] + padding * 2
+    font = get_render_font(style['font_path'], style['font_size'])
+    return int(max(font.getbbox(line)[2] for line in lines.text())) + padding * 2
 
-        sfv_hash_input = sfv_data + datetime.now().strftime("%Y%m%d%H%M%S%f")
-        sfv_hash_object = hashlib.md5(sfv_hash_input.encode())
-        sfv_hexdig = sfv_hash_object.hexdigest()
+def clip_nfo_lines(lines, style=None):
+    if not lines:
+        return NfoLines([b''])
+    style = style or render_style()
+    padding = 20
+    # Scaled variants are enlarged after rendering, so they get a smaller share of the pixel budget
+    max_lines = (max_render_pixels // style['scale'] ** 2 // nfo_image_width(lines, style) - padding * 2) // style['font_size']
+    return lines[:max(1, max_lines)]
 
-        sfv_image_path = f"static/{sfv_hexdig}.png"
-        sfv_image.save(sfv_image_path)
+def should_tile(lines):
+    return tile_lines > 0 and len(lines) > tile_lines
 
-        sfv_data_path = f"static/{sfv_hexdig}.sfv"
-        with open(sfv_data_path, 'wb') as f:
-            f.write(base64.b64decode(sfv_data))
-        
-        saved_paths.append({
-            'sfv_data_path': sfv_data_path,
-            'sfv_image_path': sfv_image_path,
-            'sfvname': sfvname,
-            'sfvpath': sfvpath,
-            'sfv_hexdig': sfv_hexdig
-        })
-    
-    # Save the SFV metadata to a file for later retrieval
-    sfv_metadata_path = f"static/{hexdig}_sfv_metadata.txt"
-    with open(sfv_metadata_path, 'w') as f:
-        for sfv in saved_paths:
-            f.write(f"{sfv['sfv_hexdig']}|{sfv['sfvname']}|{sfv['sfvpath']}\n")
-    
-    return saved_paths
-
-def load_sfv_metadata(hexdig):
-    sfv_metadata_path = f"static/{hexdig}_sfv_metadata.txt"
-    saved_paths = []
-    if os.path.exists(sfv_metadata_path):
-        with open(sfv_metadata_path, 'r') as f:
-            for line in f:
-                sfv_hexdig, sfvname, sfvpath = line.strip().split('|')
-                sfv_data_path = f"static/{sfv_hexdig}.sfv"
-                sfv_image_path = f"static/{sfv_hexdig}.png"
-                saved_paths.append({
-                    'sfv_data_path': sfv_data_path,
-                    'sfv_image_path': sfv_image_path,
-                    'sfvname': sfvname,
-                    'sfvpath': sfvpath,
-                    'sfv_hexdig': sfv_hexdig
-                })
-    return saved_paths
+def nfo_tile_layout(lines):
+    # (width, height) of every strip, top padding goes on the first and bottom padding on the last
+    padding = 20
+    width = nfo_image_width(lines)
+    tiles = []
+    for start in range(0, len(lines), tile_lines):
+        end = min(start + tile_lines, len(lines))
+        height = (end - start) * font_size
+        if start == 0:
+            height += padding
+        if end == len(lines):
+            height += padding
+        tiles.append((width, height))
+    return tiles
+
+def render_nfo_strip(lines, index, style=None):
+    # Render the strip with a line of context either side so anything that spills over a line boundary comes out
+    # the same as in the full image, then crop it back down to the strip's own rows
+    style = style or render_style()
+    font_size = style['font_size']
+    padding = 20
+    start = index * tile_lines
+    end = min(start + tile_lines, len(lines))
+    if start >= end:
+        raise IndexError(f"No strip {index}")
+    context_start = max(start - 1, 0)
+    image = render_nfo_to_image(lines[context_start:end + 1], style)
+
+    top = padding + (start - context_start) * font_size if start > 0 else 0
+    bottom = padding + (end - context_start) * font_size
+    if end == len(lines):
+        bottom += padding
+    strip = image.crop((0, top, image.width, bottom))
+
+    # The context render is only as wide as its own lines, every strip has to be as wide as the whole NFO
+    width = nfo_image_width(lines, style)
+    if strip.width == width:
+        return strip
+    canvas = Image.new(strip.mode, (width, strip.height), color=0 if strip.mode == 'P' else style['background_color'])
+    if strip.mode == 'P':
+        canvas.putpalette(strip.getpalette())
+    canvas.paste(strip, (0, 0))
+    return canvas
+
+# Rasterize the render font up front so the first upload doesn't pay for it
+if use_glyph_atlas:
+    get_glyph_atlas(font_path, font_size)
 
 #----------------------
-#-API Stuff
-@app.route('/upload_nfo', methods=['POST'])
-@token_required
-def upload_nfo():
-    required_fields = ['nfo_data', 'release', 'filename', 'save']
-    data = request.json
+#-PNG encoding
+# Renders are encoded exactly once, straight to bytes, and those bytes are what gets written out
+def to_palette_image(image):
+    if image.mode == 'P':
+        return image
+    # Quantizing an anti-aliased render costs more than it saves, only bother when there are a handful of colours
+    colors = image.getcolors(16)
+    if colors is None:
+        return image
+    return image.quantize(colors=len(colors))
 
-    missing_fields = [field for field in required_fields if field not in data]
-    if missing_fields:
-        return jsonify({"url": None, "message": f"Missing fields: {', '.join(missing_fields)}"}), 400
+def encode_png(image):
+    options = {'compress_level': png_compress_level}
+    if png_palette_mode:
+        image = to_palette_image(image)
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    if image.mode == 'P':
+        palette_size = len(image.getpalette()) // 3
+        for bits in (1, 2, 4):
+            if palette_size <= 1 << bits:
+                options['bits'] = bits
+                break
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", **options)
+    return buffer.getvalue()
+
+def write_file_atomic(path, data):
+    # Write next to the target and rename over it so nobody ever serves a half written file
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+#----------------------
+#-Render executor
+# Rendering holds the GIL for long stretches, so with render_processes set the work goes to a pool of worker
+# processes that each load the render fonts once. Jobs take the raw NFO/SFV bytes and hand back encoded PNG bytes.
+# The pool is forked from the daemon, so it's only available where fork is (render in-thread everywhere else).
+class RenderQueueFull(Exception):
+    pass
+
+render_pool = None
+render_jobs_pending = 0
+render_jobs_lock = threading.Lock()
+
+def render_png(lines, strip=None, variant=None):
+    image_data, timings = render_png_timed(lines, strip, variant)
+    for stage, seconds in timings.items():
+        observe_stage(stage, seconds)
+    return image_data
+
+def render_png_timed(lines, strip=None, variant=None):
+    # This is what runs in the render pool, so the timings are handed back for the daemon to record. lines come in
+    # already decoded, NfoLines pickle fine
+    started = time.perf_counter()
+    style = render_style(variant)
+    lines = clip_nfo_lines(lines, style)
+    image = render_nfo_to_image(lines, style) if strip is None else render_nfo_strip(lines, strip, style)
+    if variant:
+        image = resize_variant(image, variant)
+    rendered = time.perf_counter()
+    image_data = encode_png(image)
+    return image_data, {'render': rendered - started, 'png_encode': time.perf_counter() - rendered}
 
+def init_render_worker():
+    get_render_font(font_path, font_size)
+    if use_glyph_atlas:
+        get_glyph_atlas(font_path, font_size)
+
+def get_render_pool():
+    global render_pool
+    if render_processes <= 0 or 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    with render_jobs_lock:
+        if render_pool is None:
+            render_pool = ProcessPoolExecutor(max_workers=render_processes, mp_context=multiprocessing.get_context('fork'), initializer=init_render_worker)
+    return render_pool
+
+def render_queue_depth():
+    with render_jobs_lock:
+        return render_jobs_pending
+
+def finish_render_job(future):
+    global render_jobs_pending
+    with render_jobs_lock:
+        render_jobs_pending -= 1
+
+def forward_render_job(job, future):
+    # Record the timings the worker sent back and pass on just the PNG bytes
     try:
-        base64_data = data['nfo_data']
-        release = data['release']
-        filename = data['filename']
-        save = data['save']
-        date = data.get('date', '')
-        files = data.get('files', '')
-        size = data.get('size', '')
-        sfvs = data.get('sfvs', [])
+        image_data, timings = job.result()
+    except Exception as e:
+        future.set_exception(e)
+        return
+    for stage, seconds in timings.items():
+        observe_stage(stage, seconds)
+    future.set_result(image_data)
 
-        lines = read_nfo_from_base64(base64_data)
-        image = render_nfo_to_image(lines)
-       
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        buffer.seek(0)
-        
-# create a unique hash for our files
-        current_time = datetime.now().strftime("%Y%m%d%H%M%S%f")
-        hash_input = base64_data + current_time
-        hash_object = hashlib.md5(hash_input.encode())
-        hexdig = hash_object.hexdigest()
-        image_path = f"static/{hexdig}.png"
-        image.save(image_path)
-        
-# Save the release information to a file
-        release_info_path = f"static/{hexdig}.txt"
-        with open(release_info_path, 'w') as f:
-            f.write(release)
-        
-# Save the filename
-        filename_info_path = f"static/{hexdig}_filename.txt"
-        with open(filename_info_path, 'w') as f:
-            f.write(filename)
-        
-# Save the NFO data if save is allowed
-        if save:
-            nfo_data_path = f"static/{hexdig}.nfo"
-            with open(nfo_data_path, 'wb') as f:
-                f.write(base64.b64decode(base64_data))
+def submit_render(lines, strip=None, variant=None):
+    # Returns a future for the PNG bytes. Without a pool the render happens right here and the future is already done
+    global render_jobs_pending
+    pool = get_render_pool()
+    if pool is None:
+        future = Future()
+        try:
+            future.set_result(render_png(lines, strip, variant))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    with render_jobs_lock:
+        if render_jobs_pending >= render_queue_limit:
+            raise RenderQueueFull(f"{render_jobs_pending} renders already queued")
+        render_jobs_pending += 1
+    try:
+        job = pool.submit(render_png_timed, lines, strip, variant)
+    except Exception:
+        finish_render_job(None)
+        raise
+    job.add_done_callback(finish_render_job)
+    future = Future()
+    job.add_done_callback(lambda job: forward_render_job(job, future))
+    return future
+
+#----------------------
+#-Admission control
+# Uploads have to get one of max_concurrent_uploads slots before they render, so a flood of uploads can't take every
+# server thread and leave nothing for viewers. A few can wait a short while for a slot, the rest are turned away
+# with a 503 and a Retry-After. Documents too big to render are rejected up front from their line count and width.
+# Renders a viewer sets off (strips, text mode PNGs, variants) get their own, separate slots the same way, so
+# anonymous image requests can't tie up every thread either.
+class UploadRejected(Exception):
+    pass
+
+class RenderSlots:
+    def __init__(self, name):
+        self.name = name
+        self.condition = threading.Condition()
+        self.running = 0
+        self.waiting = 0
+
+    @contextmanager
+    def take(self, limit, wait_queue, wait_seconds, queue=True):
+        with self.condition:
+            if limit > 0 and self.running >= limit:
+                if queue and self.waiting >= wait_queue:
+                    raise RenderQueueFull(f"{self.running} {self.name} rendering and {self.waiting} waiting")
+                self.waiting += 1
+                try:
+                    admitted = self.condition.wait_for(lambda: self.running < limit, wait_seconds if queue else None)
+                finally:
+                    self.waiting -= 1
+                if not admitted:
+                    raise RenderQueueFull(f"No render slot within {wait_seconds}s")
+            self.running += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.condition.notify()
+
+upload_slots = RenderSlots('uploads')
+view_render_slots = RenderSlots('viewer renders')
+
+def upload_slot(queue=True):
+    # Async uploads already wait their turn in the async pool, they don't take a place in the wait queue
+    return upload_slots.take(max_concurrent_uploads, upload_wait_queue, upload_wait_seconds, queue)
+
+def view_render_slot():
+    return view_render_slots.take(view_renders, view_render_wait_queue, view_render_wait_seconds)
+
+def check_render_limits(lines):
+    if max_nfo_lines > 0 and len(lines) > max_nfo_lines:
+        raise UploadRejected(f"Too many lines, the limit is {max_nfo_lines}")
+    if max_render_width > 0 and lines and nfo_image_width(lines) > max_render_width:
+        raise UploadRejected(f"Too wide, the limit is {max_render_width} pixels")
+
+#----------------------
+#-Artifact storage
+# Everything an upload needs (release info, optional fields, NFO, SFVs) is kept as one record per hexdig, and renders
+# are kept separately by render key since they can be shared between uploads. FilesystemStore keeps the files in
+# static/ and the records in an upload index, MemoryStore keeps records in a dict and evicts the oldest uploads once
+# it holds too many bytes.
+@contextmanager
+def upload_index_lock():
+    # Only needed when several processes share the index
+    if server_mode != 'production' or fcntl is None:
+        yield
+        return
+    with open(UPLOAD_INDEX_LOCK, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# The upload index is an append-only file of JSON lines, a "put" with the whole record when an upload is stored and
+# a "delete" when it expires. Every process keeps the replayed index in memory, so a lookup is a dict read. When
+# processes share it (production mode) each one picks up the others' lines before a lookup, and a compacted index
+# (a new file) means starting the replay over. The NFO, SFV and PNG bytes stay in their own files next to it.
+INDEX_RECORD_FIELDS = ('render_key', 'release', 'filename', 'save', 'date', 'files', 'size', 'render_bytes', 'deadline')
+INDEX_SFV_FIELDS = ('sfvname', 'sfvpath', 'sfv_hexdig', 'render_key')
+
+def index_line(op, hexdig, record=None):
+    entry = {'op': op, 'hexdig': hexdig}
+    if record is not None:
+        entry['record'] = record
+    return json.dumps(entry, separators=(',', ':')) + '\n'
+
+def is_upload_hexdig(value):
+    return len(value) == 32 and all(c in '0123456789abcdef' for c in value)
+
+class FilesystemStore:
+    persistent = True
+
+    def __init__(self, root='static', shared=False):
+        self.root = root
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.uploads = {}
+        self.sfv_parents = {}
+        self.index_inode = None
+        self.index_offset = 0
+        self.index_lines = 0
+        self.index_added = {}          # hexdig -> record, uploads other processes indexed that refresh() hasn't handed out yet
+        self.render_claims = {}        # render key -> deadlines of claims that no indexed upload has used yet
+
+    def put_render(self, key, data):
+        write_file_atomic(f"{self.root}/{key}.png", data)
+
+    def get_render(self, key):
+        image_path = f"{self.root}/{key}.png"
+        if not os.path.exists(image_path):
+            return None
+        with open(image_path, 'rb') as f:
+            return f.read()
+
+    def has_render(self, key):
+        return os.path.exists(f"{self.root}/{key}.png")
+
+    def render_size(self, key):
+        image_path = f"{self.root}/{key}.png"
+        return os.path.getsize(image_path) if os.path.exists(image_path) else 0
+
+    def put_source(self, key, data):
+        write_file_atomic(f"{self.root}/{key}.src", data)
+
+    def get_source(self, key):
+        source_path = f"{self.root}/{key}.src"
+        if not os.path.exists(source_path):
+            return None
+        with open(source_path, 'rb') as f:
+            return f.read()
+
+    def has_source(self, key):
+        return os.path.exists(f"{self.root}/{key}.src")
+
+    def delete_source(self, key):
+        source_path = f"{self.root}/{key}.src"
+        if os.path.exists(source_path):
+            os.remove(source_path)
+
+    def mark_pending(self, hexdig):
+        open(f"{self.root}/{hexdig}_pending.txt", 'w').close()
+
+    def clear_pending(self, hexdig):
+        pending_path = f"{self.root}/{hexdig}_pending.txt"
+        if os.path.exists(pending_path):
+            os.remove(pending_path)
+
+    def is_pending(self, hexdig):
+        return os.path.exists(f"{self.root}/{hexdig}_pending.txt")
+
+    def delete_render(self, key):
+        image_path = f"{self.root}/{key}.png"
+        if os.path.exists(image_path):
+            os.remove(image_path)
+
+    def apply_index_entry(self, entry):
+        # Returns the record if this put an upload we didn't know about
+        hexdig = entry['hexdig']
+        if entry['op'] == 'claim':
+            # hexdig is a render key here, see claim_render
+            self.render_claims.setdefault(hexdig, []).append(entry['record']['until'])
+            return None
+        if entry['op'] == 'delete':
+            self.index_added.pop(hexdig, None)
+            record = self.uploads.pop(hexdig, None)
+            for sfv in record['sfvs'] if record is not None else []:
+                self.sfv_parents.pop(sfv['sfv_hexdig'], None)
+            return None
+        known = hexdig in self.uploads
+        record = entry['record']
+        self.uploads[hexdig] = record
+        for key in [record['render_key']] + [sfv['render_key'] for sfv in record['sfvs']]:
+            claims = self.render_claims.get(key)
+            if claims:
+                claims.pop(0)
+                if not claims:
+                    del self.render_claims[key]
+        for sfv in record['sfvs']:
+            self.sfv_parents[sfv['sfv_hexdig']] = hexdig
+        return None if known else record
+
+    def read_index(self):
+        # Caller holds self.lock. Apply whatever was appended since we last looked. Uploads that are new to us wait in
+        # index_added for refresh(), whichever call happened to read their lines
+        try:
+            stat = os.stat(UPLOAD_INDEX)
+        except FileNotFoundError:
+            return
+        known = None
+        if stat.st_ino != self.index_inode:
+            # Compacted, or the first read
+            known = set(self.uploads)
+            self.uploads.clear()
+            self.sfv_parents.clear()
+            self.index_inode = stat.st_ino
+            self.index_offset = 0
+            self.index_lines = 0
+        if stat.st_size <= self.index_offset:
+            return
+        with open(UPLOAD_INDEX, 'rb') as f:
+            f.seek(self.index_offset)
+            data = f.read()
+        # Only whole lines, a writer may be half way through the last one
+        end = data.rfind(b'\n') + 1
+        added = []
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            record = self.apply_index_entry(entry)
+            if record is not None:
+                added.append((entry['hexdig'], record))
+            self.index_lines += 1
+        self.index_offset += end
+        for hexdig, record in added:
+            if self.uploads.get(hexdig) is record and (known is None or hexdig not in known):
+                self.index_added[hexdig] = record
+
+    def append_index(self, line):
+        # Caller holds self.lock
+        with upload_index_lock():
+            with open(UPLOAD_INDEX, 'a', encoding='utf-8') as f:
+                f.write(line)
+        if not self.shared:
+            # Shared indexes count lines as they're read back
+            self.index_lines += 1
+
+    def sync(self):
+        if self.shared:
+            with self.lock:
+                self.read_index()
+
+    def refresh(self):
+        # Uploads other processes have added since the last refresh(), however they were read
+        if not self.shared:
+            return []
+        with self.lock:
+            self.read_index()
+            added = list(self.index_added.items())
+            self.index_added.clear()
+        return added
+
+    def claim_render(self, key, is_stored):
+        # Production workers reuse a render another upload left in the store, but the master may be about to delete it.
+        # The check and a claim line go in under the index lock, and the master checks for claims under the same lock
+        # before it deletes anything, so either we see the files gone and render again or the master sees the claim
+        if not self.shared:
+            return is_stored()
+        with self.lock:
+            with upload_index_lock():
+                if not is_stored():
+                    return False
+                # The claim is used up by our upload's put, or runs out if the upload never gets that far
+                line = index_line('claim', key, {'until': time.time() + timeout_seconds})
+                with open(UPLOAD_INDEX, 'a', encoding='utf-8') as f:
+                    f.write(line)
+                return True
+
+    def delete_render_unless_claimed(self, key, delete):
+        # Master. Calls delete() unless a worker has claimed the render or an upload we haven't followed yet uses it
+        if not self.shared:
+            delete()
+            return True
+        with self.lock:
+            with upload_index_lock():
+                self.read_index()
+                now = time.time()
+                for claimed_key in list(self.render_claims):
+                    self.render_claims[claimed_key] = [until for until in self.render_claims[claimed_key] if until > now]
+                    if not self.render_claims[claimed_key]:
+                        del self.render_claims[claimed_key]
+                if key in self.render_claims or any(
+                    record['render_key'] == key or any(sfv['render_key'] == key for sfv in record['sfvs'])
+                    for record in self.uploads.values()
+                ):
+                    return False
+                delete()
+                return True
+
+    def load(self):
+        # Startup. Bring in any uploads still stored the old way, then replay the index
+        with self.lock:
+            with upload_index_lock():
+                self.migrate_legacy_uploads()
+            self.index_inode = None
+            self.read_index()
+            # The caller schedules everything, nothing is new after this
+            self.index_added.clear()
+            return dict(self.uploads)
+
+    def compact(self, force=False):
+        # Rewrite the index with just the live uploads once it's mostly dead lines
+        with self.lock:
+            if not force and self.index_lines <= len(self.uploads) * 2 + 64:
+                return
+            with upload_index_lock():
+                if self.shared:
+                    self.read_index()
+                data = ''.join(index_line('put', hexdig, record) for hexdig, record in self.uploads.items()).encode()
+                write_file_atomic(UPLOAD_INDEX, data)
+                self.index_inode = os.stat(UPLOAD_INDEX).st_ino
+                self.index_offset = len(data)
+                self.index_lines = len(self.uploads)
+
+    def put_upload(self, hexdig, record):
+        if record['nfo'] is not None:
+            with open(f"{self.root}/{hexdig}.nfo", 'wb') as f:
+                f.write(record['nfo'])
+            if record.get('nfo_gzip') is not None:
+                with open(f"{self.root}/{hexdig}.nfo.gz", 'wb') as f:
+                    f.write(record['nfo_gzip'])
+        for sfv in record['sfvs']:
+            with open(f"{self.root}/{sfv['sfv_hexdig']}.sfv", 'wb') as f:
+                f.write(sfv['data'])
+            if sfv.get('data_gzip') is not None:
+                with open(f"{self.root}/{sfv['sfv_hexdig']}.sfv.gz", 'wb') as f:
+                    f.write(sfv['data_gzip'])
+        # The index entry goes last, an upload only exists once it's there
+        entry = {field: record.get(field) for field in INDEX_RECORD_FIELDS}
+        entry['save'] = record['nfo'] is not None
+        entry['sfvs'] = [{field: sfv[field] for field in INDEX_SFV_FIELDS} for sfv in record['sfvs']]
+        with self.lock:
+            self.append_index(index_line('put', hexdig, entry))
+            self.apply_index_entry({'op': 'put', 'hexdig': hexdig, 'record': entry})
+
+    def get_upload(self, hexdig):
+        self.sync()
+        return self.uploads.get(hexdig)
+
+    def has_upload(self, hexdig):
+        return self.get_upload(hexdig) is not None
+
+    def get_nfo(self, hexdig, gzipped=False):
+        nfo_path = f"{self.root}/{hexdig}.nfo{'.gz' if gzipped else ''}"
+        if not os.path.exists(nfo_path):
+            return None
+        with open(nfo_path, 'rb') as f:
+            return f.read()
+
+    def get_sfv(self, sfv_hexdig, gzipped=False):
+        sfv_data_path = f"{self.root}/{sfv_hexdig}.sfv{'.gz' if gzipped else ''}"
+        if not os.path.exists(sfv_data_path):
+            return None
+        with open(sfv_data_path, 'rb') as f:
+            return f.read()
+
+    def find_sfv(self, sfv_hexdig):
+        self.sync()
+        hexdig = self.sfv_parents.get(sfv_hexdig)
+        record = self.uploads.get(hexdig) if hexdig is not None else None
+        for sfv in record['sfvs'] if record is not None else []:
+            if sfv['sfv_hexdig'] == sfv_hexdig:
+                return hexdig, sfv['sfvname'], sfv['sfvpath']
+        return None
+
+    def delete_upload(self, hexdig):
+        with self.lock:
+            if self.shared:
+                self.read_index()
+            record = self.uploads.get(hexdig)
+            if record is None:
+                return
+            for sfv in record['sfvs']:
+                for path in (f"{self.root}/{sfv['sfv_hexdig']}.sfv", f"{self.root}/{sfv['sfv_hexdig']}.sfv.gz"):
+                    if os.path.exists(path):
+                        os.remove(path)
+            for path in (f"{self.root}/{hexdig}.nfo", f"{self.root}/{hexdig}.nfo.gz"):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.append_index(index_line('delete', hexdig))
+            self.apply_index_entry({'op': 'delete', 'hexdig': hexdig})
+
+    def migrate_legacy_uploads(self):
+        # Uploads used to be a handful of metadata files each, with pending expiries in their own journal. Fold any
+        # that are still around into the index (deadlines from the journal, or going by the age of the files) and
+        # delete the old files. Caller holds self.lock and the index lock
+        deadlines = {}
+        if os.path.exists(LEGACY_EXPIRY_JOURNAL):
+            with open(LEGACY_EXPIRY_JOURNAL, 'r') as f:
+                for line in f:
+                    deadline, _, hexdig = line.strip().partition('|')
+                    if hexdig:
+                        deadlines[hexdig] = float(deadline)
+        lines = []
+        for name in os.listdir(self.root):
+            hexdig, ext = os.path.splitext(name)
+            if ext != '.txt' or not is_upload_hexdig(hexdig):
+                continue
+            record = self.read_legacy_upload(hexdig)
+            if record is not None:
+                record['render_bytes'] = self.render_size(record['render_key'])
+                record['deadline'] = deadlines.get(hexdig, os.path.getmtime(f"{self.root}/{name}") + timeout_seconds)
+                lines.append(index_line('put', hexdig, record))
+                for sfv in record['sfvs']:
+                    parent_path = f"{self.root}/{sfv['sfv_hexdig']}_parent.txt"
+                    if os.path.exists(parent_path):
+                        os.remove(parent_path)
+            for suffix in ('_filename.txt', '_optional.txt', '_sfv_metadata.txt', '_render.txt', '.txt'):
+                path = f"{self.root}/{hexdig}{suffix}"
+                if os.path.exists(path):
+                    os.remove(path)
+        if lines:
+            with open(UPLOAD_INDEX, 'a', encoding='utf-8') as f:
+                f.write(''.join(lines))
+        if os.path.exists(LEGACY_EXPIRY_JOURNAL):
+            os.remove(LEGACY_EXPIRY_JOURNAL)
+
+    def read_legacy_upload(self, hexdig):
+        release_info_path = f"{self.root}/{hexdig}.txt"
+        filename_info_path = f"{self.root}/{hexdig}_filename.txt"
+        if not os.path.exists(release_info_path) or not os.path.exists(filename_info_path):
+            return None
+
+        render_key = hexdig
+        render_info_path = f"{self.root}/{hexdig}_render.txt"
+        if os.path.exists(render_info_path):
+            with open(render_info_path, 'r') as f:
+                render_key = f.read()
+
+        with open(release_info_path, 'r') as f:
+            release = f.read()
+        with open(filename_info_path, 'r') as f:
+            filename = f.read()
+
+        date, files, size = '', '', ''
+        optional_fields_path = f"{self.root}/{hexdig}_optional.txt"
+        if os.path.exists(optional_fields_path):
+            with open(optional_fields_path, 'r') as f:
+                optional_fields = f.read().splitlines()
+                if len(optional_fields) > 0:
+                    date = optional_fields[0]
+                if len(optional_fields) > 1:
+                    files = optional_fields[1]
+                if len(optional_fields) > 2:
+                    size = optional_fields[2]
+
+        sfvs = []
+        sfv_metadata_path = f"{self.root}/{hexdig}_sfv_metadata.txt"
+        if os.path.exists(sfv_metadata_path):
+            with open(sfv_metadata_path, 'r') as f:
+                for line in f:
+                    fields = line.strip().split('|')
+                    sfv_hexdig, sfvname, sfvpath = fields[:3]
+                    # Older metadata has no render key, the PNG is named after the SFV hash
+                    sfvs.append({
+                        'sfvname': sfvname,
+                        'sfvpath': sfvpath,
+                        'sfv_hexdig': sfv_hexdig,
+                        'render_key': fields[3] if len(fields) > 3 else sfv_hexdig
+                    })
+
+        return {
+            'render_key': render_key,
+            'release': release,
+            'filename': filename,
+            'save': os.path.exists(f"{self.root}/{hexdig}.nfo"),
+            'date': date,
+            'files': files,
+            'size': size,
+            'sfvs': sfvs
+        }
+
+    def usage(self):
+        # (artifacts, bytes, uploads) currently in static/
+        artifacts, size = 0, 0
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                try:
+                    size += entry.stat().st_size
+                except FileNotFoundError:
+                    # Expired while we were counting
+                    continue
+                artifacts += 1
+        return artifacts, size, len(self.uploads)
+
+    def sweep(self, is_live, keep=(), before=None):
+        # Remove anything that doesn't belong to a live upload, SFV or render. Files written since before are left
+        # alone, the daemon is already taking uploads while this runs
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                owner = entry.name.split('.')[0].split('_')[0]
+                if entry.name in keep or is_live(owner):
+                    continue
+                try:
+                    if before is None or entry.stat().st_mtime < before:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+class MemoryStore:
+    persistent = False
+
+    def __init__(self, max_bytes, on_evict=None):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.lock = threading.Lock()
+        self.uploads = OrderedDict()  # oldest first, that's the eviction order
+        self.renders = {}
+        self.sources = {}
+        self.sfvs = {}
+        self.size = 0
+
+    def record_size(self, record):
+        size = len(record['nfo'] or b'') + len(record.get('nfo_gzip') or b'')
+        size += sum(len(sfv['data']) + len(sfv.get('data_gzip') or b'') for sfv in record['sfvs'])
+        return size + sum(len(str(record[field])) for field in ('release', 'filename', 'date', 'files', 'size'))
+
+    def put_render(self, key, data):
+        with self.lock:
+            old = self.renders.get(key)
+            self.size += len(data) - (len(old) if old is not None else 0)
+            self.renders[key] = data
+        self.evict()
+
+    def get_render(self, key):
+        return self.renders.get(key)
+
+    def has_render(self, key):
+        return key in self.renders
+
+    def render_size(self, key):
+        return len(self.renders.get(key, b''))
+
+    def delete_render(self, key):
+        with self.lock:
+            data = self.renders.pop(key, None)
+            if data is not None:
+                self.size -= len(data)
+
+    def put_source(self, key, data):
+        with self.lock:
+            old = self.sources.get(key)
+            self.size += len(data) - (len(old) if old is not None else 0)
+            self.sources[key] = data
+        self.evict()
+
+    def get_source(self, key):
+        return self.sources.get(key)
+
+    def has_source(self, key):
+        return key in self.sources
+
+    def delete_source(self, key):
+        with self.lock:
+            data = self.sources.pop(key, None)
+            if data is not None:
+                self.size -= len(data)
+
+    def put_upload(self, hexdig, record):
+        with self.lock:
+            self.uploads[hexdig] = record
+            for sfv in record['sfvs']:
+                self.sfvs[sfv['sfv_hexdig']] = sfv
+            self.size += self.record_size(record)
+        self.evict()
+
+    def get_upload(self, hexdig):
+        return self.uploads.get(hexdig)
+
+    def has_upload(self, hexdig):
+        return hexdig in self.uploads
+
+    def find_sfv(self, sfv_hexdig):
+        # Single process only, sfv_index always has these
+        return None
+
+    def get_nfo(self, hexdig, gzipped=False):
+        record = self.uploads.get(hexdig)
+        if record is None:
+            return None
+        return record.get('nfo_gzip') if gzipped else record['nfo']
+
+    def get_sfv(self, sfv_hexdig, gzipped=False):
+        sfv = self.sfvs.get(sfv_hexdig)
+        if sfv is None:
+            return None
+        return sfv.get('data_gzip') if gzipped else sfv['data']
+
+    def delete_upload(self, hexdig):
+        with self.lock:
+            record = self.uploads.pop(hexdig, None)
+            if record is None:
+                return
+            for sfv in record['sfvs']:
+                self.sfvs.pop(sfv['sfv_hexdig'], None)
+            self.size -= self.record_size(record)
+
+    def evict(self):
+        # Expire the oldest uploads early until we're back under budget, always keeping the newest one
+        while True:
+            with self.lock:
+                if self.size <= self.max_bytes or len(self.uploads) <= 1:
+                    return
+                hexdig = next(iter(self.uploads))
+            if self.on_evict is not None:
+                self.on_evict(hexdig)
+            self.delete_upload(hexdig)
+
+    def usage(self):
+        with self.lock:
+            return len(self.uploads) + len(self.renders) + len(self.sources) + len(self.sfvs), self.size, len(self.uploads)
+
+    def load(self):
+        return dict(self.uploads)
+
+    def refresh(self):
+        return []
+
+    def claim_render(self, key, is_stored):
+        return is_stored()
+
+    def delete_render_unless_claimed(self, key, delete):
+        delete()
+        return True
+
+    def compact(self, force=False):
+        pass
+
+    def sweep(self, is_live, keep=(), before=None):
+        pass
+
+def create_store():
+    if storage_backend == 'memory':
+        return MemoryStore(memory_store_max_bytes, on_evict=lambda hexdig: expire_upload(hexdig))
+    return FilesystemStore('static', shared=server_mode == 'production')
+
+if static_offload == 'x-sendfile':
+    app.config['USE_X_SENDFILE'] = True
+
+storage = create_store()
+
+#----------------------
+#-Render cache
+# The same NFO/SFV often gets posted by several bots, so renders are content addressed: the key is a hash of the
+# decoded bytes plus the render settings. Each upload holds a reference on the renders it uses and the PNG is only
+# deleted once the last upload referencing it expires.
+render_cache = {}
+render_cache_lock = threading.Lock()
+
+def render_cache_hasher():
+    settings = f"{font_path}|{font_size}|{font_color}|{background_color}{'|ansi' if nfo_ansi_mode else ''}".encode()
+    return hashlib.sha256(settings + b'\0')
+
+def render_cache_key(data):
+    hasher = render_cache_hasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+def reserve_render(key):
+    # Take a reference on key, returns (entry, owner). A key whose last upload just expired keeps a tombstone entry
+    # until its files are deleted, wait that out so we don't write a render only to have it deleted under us
+    while True:
+        with render_cache_lock:
+            entry = render_cache.get(key)
+            released = entry.get('released') if entry is not None else None
+            if released is None:
+                owner = entry is None
+                if owner:
+                    entry = {'refs': 0, 'ready': threading.Event(), 'failed': False}
+                    render_cache[key] = entry
+                entry['refs'] += 1
+                return entry, owner
+        released.wait()
+
+# Renders are started and finished separately so an upload can get all of its renders going before it waits on any
+def start_render(data, key=None, lines=None):
+    # lines are data decoded, uploads pass in the ones they were checked with
+    if key is None:
+        key = render_cache_key(data)
+    entry, owner = reserve_render(key)
+    if not owner:
+        with render_cache_lock:
+            render_cache_lookups['hit'] += 1
+
+    if owner:
+        try:
+            if lines is None:
+                lines = read_nfo_from_bytes(data)
+            tiled = should_tile(lines)
+            # Text mode and tall NFOs keep their source and images get rendered when they're viewed. Variants are
+            # rendered from the source too
+            keep_source = render_mode == 'text' or tiled or render_variants
+            render_now = render_mode != 'text' and not tiled
+            # Production workers drop their references once an upload is stored, so a duplicate upload finds the
+            # render in the store rather than in render_cache
+            stored = storage.claim_render(key, lambda: (not keep_source or storage.has_source(key)) and (not render_now or storage.has_render(key)))
+            with render_cache_lock:
+                render_cache_lookups['hit' if stored else 'miss'] += 1
+            if not stored:
+                if keep_source:
+                    entry['source'] = data
+                if render_now:
+                    entry['job'] = submit_render(lines)
+        except Exception:
+            fail_render(key, entry)
+            raise
+    return key, entry, owner
+
+def fail_render(key, entry):
+    with render_cache_lock:
+        entry['failed'] = True
+        render_cache.pop(key, None)
+    entry['ready'].set()
+
+def finish_render(render):
+    key, entry, owner = render
+    if not owner:
+        # Someone else has it (or is still rendering it), wait for them to finish
+        entry['ready'].wait()
+        if entry['failed']:
+            raise RuntimeError(f"Render {key} failed")
+        return key
+
+    try:
+        image_data = entry.pop('job').result(timeout=render_timeout) if 'job' in entry else None
+        if image_data is not None or 'source' in entry:
+            with timed_stage('store_write'):
+                if image_data is not None:
+                    storage.put_render(key, image_data)
+                if 'source' in entry:
+                    storage.put_source(key, entry.pop('source'))
+    except Exception:
+        fail_render(key, entry)
+        raise
+    entry['ready'].set()
+    return key
+
+def acquire_render(data, key=None, lines=None):
+    return finish_render(start_render(data, key, lines))
+
+def render_exists(key):
+    return storage.has_render(key) or storage.has_source(key)
+
+def render_images(key, lines=None):
+    # What the viewer has to show for a render: one PNG, or its strips. A fresh upload passes in its lines, otherwise
+    # they're read back from the kept source
+    if render_mode == 'text':
+        return [{'src': f"/static/{key}.png"}]
+    if lines is None:
+        source = storage.get_source(key)
+        if source is None:
+            return [{'src': f"/static/{key}.png"}]
+        lines = read_nfo_from_bytes(source)
+    if not should_tile(lines):
+        return [{'src': f"/static/{key}.png"}]
+    tiles = nfo_tile_layout(clip_nfo_lines(lines))
+    return [{'src': f"/static/{key}_{index}.png", 'width': width, 'height': height} for index, (width, height) in enumerate(tiles)]
+
+# CP437 draws glyphs for the control bytes, browsers don't. Swap them for the Unicode characters of those glyphs.
+# Tab and the line breaks keep their meaning in a <pre>, so those three stay as they are.
+CP437_CONTROL_GLYPHS = str.maketrans({
+    code: glyph for code, glyph in zip(list(range(32)) + [127], ' ☺☻♥♦♣♠•◘○◙♂♀♪♫☼►◄↕‼¶§▬↨↑↓→←∟↔▲▼⌂') if code not in (9, 10, 13)
+})
+
+def render_text(key, lines=None):
+    # In text mode the viewer gets the NFO itself instead of a picture of it
+    if render_mode != 'text':
+        return None
+    if lines is None:
+        source = storage.get_source(key)
+        if source is None:
+            return None
+        lines = read_nfo_from_bytes(source)
+    return b'\n'.join(lines).decode('cp437').translate(CP437_CONTROL_GLYPHS)
+
+def get_render_image(key):
+    image_data = storage.get_render(key)
+    if image_data is not None:
+        return image_data
+    # Text mode and tiled sources only get a full PNG once somebody asks for one
+    source = storage.get_source(key)
+    if source is None:
+        return None
+    with view_render_slot():
+        image_data = submit_render(read_nfo_from_bytes(source)).result(timeout=render_timeout)
+    with timed_stage('store_write'):
+        storage.put_render(key, image_data)
+    return image_data
+
+def get_render_strip(key, index):
+    name = f"{key}_{index}"
+    image_data = storage.get_render(name)
+    if image_data is not None:
+        return image_data
+    source = storage.get_source(key)
+    if source is None:
+        return None
+    with view_render_slot():
+        image_data = submit_render(read_nfo_from_bytes(source), index).result(timeout=render_timeout)
+    with timed_stage('store_write'):
+        storage.put_render(name, image_data)
+    return image_data
+
+#----------------------
+#-Render variants
+# /static/<key>.png (and its strips) can be asked for in another font, enlarged, with the colours swapped or shrunk to
+# a thumbnail. Variants are rendered from the kept source the first time they're asked for and held in memory, least
+# recently used first, up to variant_cache_bytes.
+variant_cache = OrderedDict()          # (render key, strip, variant name) -> PNG bytes
+variant_cache_size = 0
+variant_cache_lookups = {'hit': 0, 'miss': 0}
+variant_cache_lock = threading.Lock()
+
+def parse_render_variant(args):
+    # None for a plain request, ValueError for anything we don't offer
+    if not args:
+        return None
+    if set(args) - {'font', 'scale', 'invert', 'width'}:
+        raise ValueError(f"Unknown parameters: {', '.join(sorted(set(args) - {'font', 'scale', 'invert', 'width'}))}")
+    variant = {}
+    font = args.get('font')
+    if font and font != 'default':
+        if font not in variant_fonts:
+            raise ValueError(f"Unknown font {font}")
+        variant['font'] = font
+    try:
+        scale = int(args.get('scale', 1))
+        width = int(args['width']) if 'width' in args else None
+    except ValueError:
+        raise ValueError("Scale and width must be whole numbers")
+    if not 1 <= scale <= variant_max_scale:
+        raise ValueError(f"Scale must be 1 to {variant_max_scale}")
+    if scale > 1:
+        variant['scale'] = scale
+    if args.get('invert', '0') not in ('0', '1', 'false', 'true'):
+        raise ValueError("Invert must be 0 or 1")
+    if args.get('invert') in ('1', 'true'):
+        variant['invert'] = True
+    if width is not None:
+        if width not in variant_widths:
+            raise ValueError(f"Width must be one of {', '.join(str(w) for w in variant_widths)}")
+        variant['width'] = width
+    return variant or None
+
+def variant_name(variant):
+    # Stable name for the cache and the ETag, e.g. itt-x2-inverted-w320
+    parts = [variant.get('font', 'default')]
+    if 'scale' in variant:
+        parts.append(f"x{variant['scale']}")
+    if variant.get('invert'):
+        parts.append('inverted')
+    if 'width' in variant:
+        parts.append(f"w{variant['width']}")
+    return '-'.join(parts)
+
+def resize_variant(image, variant):
+    scale = variant.get('scale', 1)
+    if scale > 1:
+        # Nearest neighbour keeps the glyphs sharp and a palette image stays a palette image
+        image = image.resize((image.width * scale, image.height * scale), Image.NEAREST)
+    width = variant.get('width')
+    if width and image.width > width:
+        if image.mode == 'P':
+            image = image.convert('RGB')
+        image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+    return image
+
+def cache_variant(cache_key, image_data):
+    global variant_cache_size
+    with variant_cache_lock:
+        old = variant_cache.pop(cache_key, None)
+        if old is not None:
+            variant_cache_size -= len(old)
+        if len(image_data) > variant_cache_bytes:
+            return
+        variant_cache[cache_key] = image_data
+        variant_cache_size += len(image_data)
+        while variant_cache_size > variant_cache_bytes:
+            _, dropped = variant_cache.popitem(last=False)
+            variant_cache_size -= len(dropped)
+
+def drop_variants(key):
+    global variant_cache_size
+    with variant_cache_lock:
+        for cache_key in [cache_key for cache_key in variant_cache if cache_key[0] == key]:
+            variant_cache_size -= len(variant_cache.pop(cache_key))
+
+def get_render_variant(key, strip, variant):
+    # The source check also catches renders another production process has expired
+    source = storage.get_source(key)
+    if source is None:
+        drop_variants(key)
+        return None
+    cache_key = (key, strip, variant_name(variant))
+    with variant_cache_lock:
+        image_data = variant_cache.get(cache_key)
+        if image_data is not None:
+            variant_cache.move_to_end(cache_key)
+        variant_cache_lookups['miss' if image_data is None else 'hit'] += 1
+    if image_data is None:
+        with view_render_slot():
+            image_data = submit_render(read_nfo_from_bytes(source), strip, variant).result(timeout=render_timeout)
+        cache_variant(cache_key, image_data)
+    return image_data
+
+#----------------------
+#-Upload ingest
+# Every NFO/SFV that comes in ends up as an UploadBlob: the raw bytes, their render key and a running md5 for the
+# upload hash. Raw and multipart uploads fill all three in a single pass over the body as it streams in, JSON uploads
+# get theirs from the base64 decoded bytes. The decoded lines are added by decode_blob once the upload is checked,
+# and everything after that (limits, tiling, the render itself, the viewer page) works from them.
+class UploadBlob:
+    def __init__(self, data, render_key, hasher):
+        self.data = data
+        self.render_key = render_key
+        self.hasher = hasher
+        self.lines = None
+
+def decode_blob(blob):
+    blob.lines = read_nfo_from_bytes(blob.data)
+    return blob
+
+def blob_from_bytes(data):
+    return UploadBlob(data, render_cache_key(data), hashlib.md5(data))
+
+def read_upload_stream(stream):
+    render_hasher = render_cache_hasher()
+    upload_hasher = hashlib.md5()
+    # BytesIO.getvalue hands over its buffer instead of copying it, so the body is only held once
+    data = BytesIO()
+    while True:
+        chunk = stream.read(upload_chunk_size)
+        if not chunk:
+            break
+        if data.tell() + len(chunk) > max_upload_bytes:
+            raise RequestEntityTooLarge()
+        data.write(chunk)
+        render_hasher.update(chunk)
+        upload_hasher.update(chunk)
+    return UploadBlob(data.getvalue(), render_hasher.hexdigest(), upload_hasher)
+
+def gzip_download(data):
+    # Downloads are compressed once when they're stored, not on every request. Not worth keeping if it doesn't shrink
+    if not precompress_downloads:
+        return None
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    return compressed if len(compressed) < len(data) else None
+
+def new_upload_hexdig(blob):
+    # create a unique hash for our files
+    hasher = blob.hasher.copy()
+    hasher.update(datetime.now().strftime("%Y%m%d%H%M%S%f").encode())
+    return hasher.hexdigest()
+
+def release_render(key):
+    with render_cache_lock:
+        entry = render_cache.get(key)
+        if entry is None or 'released' in entry:
+            return
+        entry['refs'] -= 1
+        if entry['refs'] > 0:
+            return
+        if worker_process:
+            # Production workers don't own expiry, a render they drop may still be used by an upload on another worker
+            del render_cache[key]
+            return
+        # The entry stays as a tombstone while the files go, see reserve_render
+        entry['released'] = threading.Event()
+    def delete_files():
+        source = storage.get_source(key)
+        if source is not None:
+            for index in range(len(nfo_tile_layout(clip_nfo_lines(read_nfo_from_bytes(source))))):
+                storage.delete_render(f"{key}_{index}")
+            storage.delete_source(key)
+        storage.delete_render(key)
+
+    try:
+        drop_variants(key)
+        # A production worker may have just claimed it for a duplicate upload. Then the files stay, and the
+        # upload's put brings the render back into render_cache when follow_upload_index reads it
+        storage.delete_render_unless_claimed(key, delete_files)
+    finally:
+        with render_cache_lock:
+            del render_cache[key]
+        entry['released'].set()
+
+#----------------------
+#-SFV parsing
+# An SFV is mostly "filename CRC32" lines, there's no point drawing those as a bitmap. They're parsed into entries
+# for an HTML table, and only what's left over (comment lines, usually a group logo) is rendered. An SFV with no art
+# has no render at all, its render key is ''.
+def is_crc32(value):
+    return len(value) == 8 and all(c in '0123456789abcdefABCDEF' for c in value)
+
+def parse_sfv(data):
+    entries = []
+    comments = []
+    for raw_line in data.splitlines():
+        line = raw_line.decode('cp437').strip()
+        fields = line.rsplit(None, 1)
+        if not line.startswith(';') and len(fields) == 2 and is_crc32(fields[1]):
+            entries.append({'filename': fields[0], 'crc': fields[1].upper()})
         else:
-            nfo_data_path = None
-        
-        # Save optional data
-        optional_fields_path = f"static/{hexdig}_optional.txt"
-        with open(optional_fields_path, 'w') as f:
-            f.write(f"{date}\n{files}\n{size}")
-        
-        # Save SFV files if provided
-        saved_sfv_paths = []
-        if sfvs:
-            saved_sfv_paths = save_sfv_files(sfvs, hexdig)
+            comments.append(raw_line.rstrip())
+    # Blank lines only count inside the art, not around it
+    while comments and not comments[0].strip():
+        comments.pop(0)
+    while comments and not comments[-1].strip():
+        comments.pop()
+    return {'entries': entries, 'comments': comments}
 
-        # Server the web page!
-        threading.Thread(target=remove_file_after_delay, args=(image_path, release_info_path, nfo_data_path, filename_info_path, saved_sfv_paths, timeout_seconds)).start() 
-        
-        return jsonify({"url": f"/viewer/{hexdig}", "message": "Success"})
-        
-    except Exception as e:
-        return jsonify({"url": None, "message": "Error"}), 500
+def sfv_art(data):
+    # The bytes that still need rendering, None if there's nothing to draw
+    if sfv_render_mode != 'table':
+        return data
+    comments = parse_sfv(data)['comments']
+    return b'\r\n'.join(comments) + b'\r\n' if comments else None
 
-@app.route('/viewer/<filename>')
-def serve_image(filename):
-    image_path = f"static/{filename}.png"
-    release_info_path = f"static/{filename}.txt"
-    filename_info_path = f"static/{filename}_filename.txt"
-    optional_fields_path = f"static/{filename}_optional.txt"
-    nfo_data_path = f"static/{filename}.nfo"
-    
-    if not os.path.exists(image_path) or not os.path.exists(release_info_path) or not os.path.exists(filename_info_path):
-        return render_template_string('''
+def sfv_filename_key(filename):
+    return filename.replace('\\', '/').lower()
+
+def verify_sfv_crcs(entries, supplied):
+    # Check {filename: crc} against the SFV's entries. Names are matched case-insensitively, then every CRC is
+    # compared in one numpy pass
+    index = {sfv_filename_key(entry['filename']): i for i, entry in enumerate(entries)}
+    expected = np.array([int(entry['crc'], 16) for entry in entries], dtype=np.uint32)
+    positions, values, checked = [], [], []
+    unknown, invalid = [], []
+    supplied_positions = np.zeros(len(entries), dtype=bool)
+    for filename, crc in supplied.items():
+        position = index.get(sfv_filename_key(str(filename)))
+        if position is None:
+            unknown.append(filename)
+            continue
+        supplied_positions[position] = True
+        if isinstance(crc, int) and 0 <= crc <= 0xFFFFFFFF:
+            value = crc
+        elif isinstance(crc, str) and is_crc32(crc.strip()):
+            value = int(crc.strip(), 16)
+        else:
+            invalid.append({'filename': filename, 'expected': entries[position]['crc'], 'got': crc})
+            continue
+        positions.append(position)
+        values.append(value)
+        checked.append(filename)
+
+    positions = np.array(positions, dtype=np.intp)
+    values = np.array(values, dtype=np.uint32)
+    matches = expected[positions] == values
+    return {
+        'ok': [filename for filename, match in zip(checked, matches) if match],
+        'bad': [{'filename': filename, 'expected': entries[position]['crc'], 'got': f"{value:08X}"}
+                for filename, position, value, match in zip(checked, positions, values, matches) if not match] + invalid,
+        'missing': [entries[i]['filename'] for i in np.flatnonzero(~supplied_positions)],
+        'unknown': unknown
+    }
+
+def read_sfv_blobs(sfvs):
+    # Raw uploads hand over SFVs that were already read in, JSON ones are still base64. Either way every SFV is
+    # checked against the render limits here, before the upload renders anything
+    read = []
+    for sfv in sfvs:
+        blob = sfv.get('sfv_blob')
+        if not isinstance(blob, UploadBlob):
+            with timed_stage('base64_decode'):
+                sfv_data = base64.b64decode(sfv['sfv_data'])
+            blob = blob_from_bytes(sfv_data)
+        check_render_limits(decode_blob(blob).lines)
+        read.append(dict(sfv, sfv_blob=blob))
+    return read
+
+def save_sfv_files(sfvs):
+    # sfvs have been through read_sfv_blobs
+    decoded = [(sfv['sfvname'], sfv.get('sfvpath', ''), sfv['sfv_blob']) for sfv in sfvs]
+
+    # Start every render before waiting on any of them, so with a render pool the SFVs render in parallel
+    error = None
+    renders = []
+    for sfvname, sfvpath, blob in decoded:
+        try:
+            art = sfv_art(blob.data)
+            if art is None:
+                renders.append(None)
+            else:
+                renders.append(start_render(art, blob.render_key, blob.lines) if art is blob.data else start_render(art))
+        except Exception as e:
+            error = e
+            break
+
+    # Every started render has to be finished, even after a failure, or anyone sharing it would wait forever
+    saved_sfvs = []
+    for (sfvname, sfvpath, blob), render in zip(decoded, renders):
+        try:
+            render_key = finish_render(render) if render is not None else ''
+        except Exception as e:
+            error = error or e
+            continue
+
+        saved_sfvs.append({
+            'sfvname': sfvname,
+            'sfvpath': sfvpath,
+            'sfv_hexdig': new_upload_hexdig(blob),
+            'render_key': render_key,
+            'data': blob.data,
+            'data_gzip': gzip_download(blob.data)
+        })
+
+    if error is not None:
+        # Don't leave references behind for an upload that never made it
+        for sfv in saved_sfvs:
+            release_render(sfv['render_key'])
+        raise error
+
+    return saved_sfvs
+
+#----------------------
+#-SFV index
+# sfv_hexdig -> (parent hexdig, sfvname, sfvpath), so an SFV download is a dict lookup instead of a walk over every
+# metadata file in static/. Entries are added once an upload is stored and dropped when it expires.
+sfv_index = {}
+sfv_index_lock = threading.Lock()
+
+def index_sfvs(hexdig, sfvs):
+    with sfv_index_lock:
+        for sfv in sfvs:
+            sfv_index[sfv['sfv_hexdig']] = (hexdig, sfv['sfvname'], sfv['sfvpath'])
+
+def unindex_sfvs(sfvs):
+    with sfv_index_lock:
+        for sfv in sfvs:
+            sfv_index.pop(sfv['sfv_hexdig'], None)
+
+batch_executor = ThreadPoolExecutor(max_workers=batch_workers, thread_name_prefix='batch-upload')
+
+#----------------------
+#-Viewer pages
+# The viewer templates are compiled once at startup, and each upload's page is rendered once (at upload time, or on
+# first view after a restart) and kept until the upload expires. Repeat hits just send the cached bytes, or a 304.
+NOT_FOUND_TEMPLATE = '''
             <!doctype html>
             <html lang="en">
               <head>
@@ -252,90 +1930,18 @@ def serve_image(filename):
                 </div>
               </body>
             </html>
-        '''), 404
-    
-    with open(release_info_path, 'r') as f:
-        release = f.read()
-
-    with open(filename_info_path, 'r') as f:
-        original_filename = f.read()
-    
-    date, files, size = '', '', ''
-    if os.path.exists(optional_fields_path):
-        with open(optional_fields_path, 'r') as f:
-            optional_fields = f.read().splitlines()
-            if len(optional_fields) > 0:
-                date = optional_fields[0]
-            if len(optional_fields) > 1:
-                files = optional_fields[1]
-            if len(optional_fields) > 2:
-                size = f"{optional_fields[2]} MB" if optional_fields[2] else ""
-    
-    if os.path.exists(nfo_data_path):
-        download_button = f'<hr><div style="text-align: center;"><a href="/download/{filename}" class="download-button">Download NFO</a></div>'
-        expired_message = '<div id="expired-banner" class="expired-banner" style="display:none; font-weight:bold; color:red; text-align: center;">Hash has expired</div>'
-        
-    else:
-        download_button = ''
-        expired_message = '<div id="expired-banner" class="expired-banner" style="display:none; font-weight:bold; color:red; text-align: center;">Hash has expired</div>'
-
-    max_label_length = max(len(label) for label in ["File Name", "Pre Date", "Files", "Size"])
-    max_value_length = max(len(value) for value in [original_filename, date, files, size])
-    col_width = max(max_label_length, max_value_length) + 2  # Adding padding
-
-    # Load SFV metadata for display
-    saved_sfv_paths = load_sfv_metadata(filename)
-    sfv_renderings = ''
-    for sfv in saved_sfv_paths:
-        sfv_filename = sfv['sfvname']
-        sfv_image_path = sfv['sfv_image_path']
-        sfv_path = sfv['sfvpath']
-        sfv_hexdig = sfv['sfv_hexdig']
-
-        # Create SFV table HTML
-        sfv_table = f'''
-        <div class="info-table-container">
-            <table class="info-table">
-                <tr>
-                    <th>SFV Filename</th>
-                    <td>{sfv_filename}</td>
-                </tr>
-        '''
-        if sfv_path:
-            sfv_table += f'''
-                <tr>
-                    <th>SFV Path</th>
-                    <td>{sfv_path}</td>
-                </tr>
-            '''
-        sfv_table += f'''
-            </table>
-        </div>
-        <p></p>
-        <div style="text-align: center;"><a href="/download_sfv/{sfv_hexdig}" class="download-button">Download SFV</a></div>        
-        <p></p>
-        '''
-
-        sfv_renderings += f'''
-        <hr>
-        {sfv_table}
-        <table style="margin: 0 auto;">
-            <tr>
-                <td><img id="sfvImage" src="/static/{sfv_hexdig}.png" alt="SFV Image"></td>
-            </tr>
-        </table>
         '''
 
-    html_content = f'''
+VIEWER_TEMPLATE = '''
         <!doctype html>
         <html lang="en">
           <head>
             <meta charset="utf-8">
             <meta name="viewport" content="width=device-width, initial-scale=1, shrink-to-fit=no">
-            <title>{release}</title>
-            <link rel="stylesheet" href="{{{{ url_for('serve_fonts', filename='roboto.css') }}}}">
+            <title>{{ release }}</title>
+            <link rel="stylesheet" href="{{ url_for('serve_fonts', filename='roboto.css') }}">
             <style>
-                body {{
+                body {
                     background-color: #1a1a1a;  /* Dark grey background */
                     color: white;
                     display: flex;
@@ -345,65 +1951,84 @@ def serve_image(filename):
                     margin: 0;
                     font-family: 'Roboto', sans-serif;
                     transition: all 0.5s ease;
-                }}
-                .title-container {{
+                }
+                .title-container {
                     background-color: black;
                     border-radius: 15px;
                     padding: 10px 20px;
                     margin-top: 20px;
                     text-align: center;
-                }}
-                h4 {{
+                }
+                h4 {
                     margin: 0;
-                }}
-                .info-table-container {{
+                }
+                .info-table-container {
                     display: flex;
                     justify-content: center;
                     width: 100%;
-                }}
-                .info-table {{
+                }
+                .info-table {
                     width: auto;
                     margin-top: 20px;
                     border-collapse: collapse;
-                }}
-                .info-table td, .info-table th {{
+                }
+                .info-table td, .info-table th {
                     border: 1px solid #ddd;
                     padding: 8px;
-                    width: {col_width}ch;
-                }}
-                .info-table th {{
+                    width: {{ col_width }}ch;
+                }
+                .info-table th {
                     background-color: #333;
                     color: white;
                     text-align: right;
-                }}
-                .info-table td {{
+                }
+                .info-table td {
                     text-align: left;
-                }}
-                hr {{
+                }
+                {% if nfo_text is not none %}
+                @font-face {
+                    font-family: 'NFO';
+                    src: url("{{ url_for('serve_fonts', filename=nfo_font) }}");
+                }
+                .nfo-text {
+                    font-family: 'NFO', monospace;
+                    font-size: {{ font_size }}px;
+                    line-height: {{ font_size }}px;
+                    color: {{ font_color }};
+                    background-color: {{ background_color }};
+                    padding: 20px;
+                    margin: 0;
+                }
+                .image-link {
+                    color: #ccc;
+                    font-size: small;
+                }
+                {% endif %}
+                hr {
                     border: 1px solid white;
                     width: 100%;
                     margin: 10px 0;
-                }}
-                table {{
+                }
+                table {
                     margin-top: 20px;
                     border: 0;
                     background-color: black;  /* Black table background */
                     overflow: hidden;
-                }}
-                img {{
+                }
+                img {
                     display: block;
                     transition: all 0.5s ease;
-                }}
-                .inverted {{
+                }
+                .inverted {
                     filter: invert(100%);
                     background-color: #f0f0f0;  /* Light grey background for contrast */
-                }}
-                .dropdown {{
+                }
+                .dropdown {
                     position: absolute;
                     top: 10px;
                     right: 10px;
-                }}
-                select {{
+                }
+                select {
                     font-family: 'Roboto', sans-serif;
                     padding: 5px 10px;
                     border-radius: 15px;  /* Rounded edges */
@@ -411,12 +2036,12 @@ def serve_image(filename):
                     background-color: white;
                     color: black;
                     transition: background-color 0.5s, color 0.5s;
-                }}
-                select:focus {{
+                }
+                select:focus {
                     outline: none;
                     border-color: #888;
-                }}
-                .download-button {{
+                }
+                .download-button {
                     display: block;
                     padding: 10px 20px;
                     border-radius: 15px;
@@ -424,13 +2049,29 @@ def serve_image(filename):
                     color: black;
                     text-decoration: none;
                     font-family: 'Roboto', sans-serif.
-                }}
-                .download-button:hover {{
+                }
+                .download-button:hover {
                     background-color: #ccc;
-                }}
-                .expired-banner {{
+                }
+                .expired-banner {
                     margin-top: 10px;
-                }}
+                }
+                .sfv-table {
+                    margin: 10px auto;
+                    border-collapse: collapse;
+                    font-family: monospace;
+                    font-size: 14px;
+                }
+                .sfv-table td, .sfv-table th {
+                    border: 1px solid #444;
+                    padding: 2px 10px;
+                    text-align: left;
+                }
+                .sfv-table th {
+                    background-color: #333;
+                    color: white;
+                    font-family: 'Roboto', sans-serif;
+                }
             </style>
           </head>
           <body>
@@ -442,145 +2083,756 @@ def serve_image(filename):
             </div>
             <div id="content">
                 <div class="title-container">
-                    <h4>{release}</h4>
+                    <h4>{{ release }}</h4>
                 </div>
                 <div class="info-table-container">
                     <table class="info-table">
                         <tr>
                             <th>File Name</th>
-                            <td>{original_filename}</td>
+                            <td>{{ original_filename }}</td>
                         </tr>
-        '''
-    if date:
-        html_content += f'''
+                        {% if date %}
                         <tr>
                             <th>Pre Date</th>
-                            <td>{date}</td>
+                            <td>{{ date }}</td>
                         </tr>
-        '''
-    if files:
-        html_content += f'''
+                        {% endif %}
+                        {% if files %}
                         <tr>
                             <th>Files</th>
-                            <td>{files}</td>
+                            <td>{{ files }}</td>
                         </tr>
-        '''
-    if size:
-        html_content += f'''
+                        {% endif %}
+                        {% if size %}
                         <tr>
                             <th>Size</th>
-                            <td>{size}</td>
+                            <td>{{ size }}</td>
                         </tr>
-        '''
-    html_content += f'''
+                        {% endif %}
                     </table>
                 </div>
-                {download_button}
-                {expired_message}
+                {% if save %}
+                <hr><div style="text-align: center;"><a href="/download/{{ hexdig }}" class="download-button">Download NFO</a></div>
+                {% endif %}
+                <div id="expired-banner" class="expired-banner" style="display:none; font-weight:bold; color:red; text-align: center;">Hash has expired</div>
                 <table>
                   <tr>
-                    <td><img id="nfoImage" src="/static/{filename}.png" alt="NFO Image"></td>
+                    <td>
+                      {% if nfo_text is not none %}
+                      <pre class="nfo-text">{{ nfo_text }}</pre>
+                      {% else %}
+                      {% for image in images %}
+                      <img id="nfoImage" src="{{ image.src }}" alt="NFO Image"{% if image.height %} width="{{ image.width }}" height="{{ image.height }}" loading="lazy"{% endif %}>
+                      {% endfor %}
+                      {% endif %}
+                    </td>
                   </tr>
                 </table>
-                {sfv_renderings}
+                {% if nfo_text is not none %}
+                <div style="text-align: center;"><a href="/static/{{ render_key }}.png" class="image-link">View as image</a></div>
+                {% endif %}
+                {% for sfv in sfvs %}
+                <hr>
+                <div class="info-table-container">
+                    <table class="info-table">
+                        <tr>
+                            <th>SFV Filename</th>
+                            <td>{{ sfv.sfvname }}</td>
+                        </tr>
+                        {% if sfv.sfvpath %}
+                        <tr>
+                            <th>SFV Path</th>
+                            <td>{{ sfv.sfvpath }}</td>
+                        </tr>
+                        {% endif %}
+                    </table>
+                </div>
+                <p></p>
+                <div style="text-align: center;"><a href="/download_sfv/{{ sfv.sfv_hexdig }}" class="download-button">Download SFV</a></div>
+                <p></p>
+                {% if sfv.render_key %}
+                <table style="margin: 0 auto;">
+                    <tr>
+                        <td>
+                          {% if sfv.text is not none %}
+                          <pre class="nfo-text">{{ sfv.text }}</pre>
+                          {% else %}
+                          {% for image in sfv.images %}
+                          <img id="sfvImage" src="{{ image.src }}" alt="SFV Image"{% if image.height %} width="{{ image.width }}" height="{{ image.height }}" loading="lazy"{% endif %}>
+                          {% endfor %}
+                          {% endif %}
+                        </td>
+                    </tr>
+                </table>
+                {% endif %}
+                {% if sfv.entries %}
+                <table class="sfv-table">
+                    <tr>
+                        <th>File</th>
+                        <th>CRC32</th>
+                    </tr>
+                    {% for entry in sfv.entries %}
+                    <tr>
+                        <td>{{ entry.filename }}</td>
+                        <td>{{ entry.crc }}</td>
+                    </tr>
+                    {% endfor %}
+                </table>
+                {% endif %}
+                {% endfor %}
             </div>
             <script>
-                function toggleInvert() {{
+                function toggleInvert() {
                     var body = document.body;
                     var colorMode = document.getElementById('colorMode').value;
-                    if (colorMode === 'inverted') {{
+                    if (colorMode === 'inverted') {
                         body.classList.add('inverted');
-                    }} else {{
+                    } else {
                         body.classList.remove('inverted');
-                    }}
-                }}
-                document.addEventListener("DOMContentLoaded", function() {{
+                    }
+                }
+                document.addEventListener("DOMContentLoaded", function() {
                     var downloadButton = document.querySelector('.download-button');
-                    if (downloadButton) {{
-                        downloadButton.addEventListener('click', function(event) {{
+                    if (downloadButton) {
+                        downloadButton.addEventListener('click', function(event) {
                             event.preventDefault();
                             fetch(this.href)
-                                .then(response => {{
-                                    if (!response.ok) {{
+                                .then(response => {
+                                    if (!response.ok) {
                                         document.getElementById('expired-banner').style.display = 'block';
-                                    }} else {{
+                                    } else {
                                         window.location.href = this.href;
-                                    }}
-                                }});
-                        }});
-                    }}
-                }});
+                                    }
+                                });
+                        });
+                    }
+                });
             </script>
           </body>
         </html>
     '''
 
-    return render_template_string(html_content)
+RENDERING_TEMPLATE = '''
+            <!doctype html>
+            <html lang="en">
+              <head>
+                <meta charset="utf-8">
+                <meta http-equiv="refresh" content="1">
+                <meta name="viewport" content="width=device-width, initial-scale=1, shrink-to-fit=no">
+                <title>Rendering</title>
+                <link rel="stylesheet" href="{{ url_for('serve_fonts', filename='roboto.css') }}">
+                <style>
+                    body {
+                        background-color: #1a1a1a;  /* Dark grey background */
+                        color: white;
+                        display: flex;
+                        justify-content: center;
+                        align-items: flex-start;
+                        height: 100vh;
+                        margin: 0;
+                        font-family: 'Roboto', sans-serif;
+                    }
+                    .rendering-container {
+                        background-color: black;
+                        color: white;
+                        border-radius: 15px;
+                        padding: 10px 20px;
+                        text-align: center;
+                        margin-top: 20px;
+                    }
+                </style>
+              </head>
+              <body>
+                <div class="rendering-container">
+                    <h1>Rendering...</h1>
+                </div>
+              </body>
+            </html>
+        '''
+
+not_found_template = app.jinja_env.from_string(NOT_FOUND_TEMPLATE)
+rendering_template = app.jinja_env.from_string(RENDERING_TEMPLATE)
+viewer_template = app.jinja_env.from_string(VIEWER_TEMPLATE)
+
+viewer_page_cache = {}
+
+def sfv_view(sfv):
+    view = dict(sfv, images=[], text=None, entries=None)
+    if sfv['render_key']:
+        view['images'] = render_images(sfv['render_key'])
+        view['text'] = render_text(sfv['render_key'])
+    if sfv_render_mode == 'table':
+        data = sfv.get('data') or storage.get_sfv(sfv['sfv_hexdig'])
+        view['entries'] = parse_sfv(data)['entries'] if data is not None else []
+    return view
+
+def build_viewer_page(hexdig, record, lines=None):
+    original_filename = str(record['filename'])
+    date = str(record['date'])
+    files = str(record['files'])
+    size = f"{record['size']} MB" if record['size'] else ""
+
+    max_label_length = max(len(label) for label in ["File Name", "Pre Date", "Files", "Size"])
+    max_value_length = max(len(value) for value in [original_filename, date, files, size])
+    col_width = max(max_label_length, max_value_length) + 2  # Adding padding
+
+    html = viewer_template.render(
+        hexdig=hexdig,
+        render_key=record['render_key'],
+        images=render_images(record['render_key'], lines),
+        nfo_text=render_text(record['render_key'], lines),
+        nfo_font=os.path.relpath(font_path, 'fonts').replace(os.sep, '/'),
+        font_size=font_size,
+        font_color=font_color,
+        background_color=background_color,
+        release=record['release'],
+        original_filename=original_filename,
+        date=date,
+        files=files,
+        size=size,
+        save=record['save'],
+        sfvs=[sfv_view(sfv) for sfv in record['sfvs']],
+        col_width=col_width
+    ).encode()
+    if worker_process:
+        # Workers never see uploads expire, anything older than the timeout is gone anyway
+        cutoff = time.time() - timeout_seconds
+        for stale in [key for key, cached in list(viewer_page_cache.items()) if cached['last_modified'].timestamp() < cutoff]:
+            viewer_page_cache.pop(stale, None)
+    page = {
+        'html': html,
+        'etag': hashlib.md5(html).hexdigest(),
+        'last_modified': datetime.now(timezone.utc).replace(microsecond=0)
+    }
+    viewer_page_cache[hexdig] = page
+    return page
+
+#----------------------
+#-Uploads
+# store_upload does the rendering and storing for every upload. An async upload is only validated and given its
+# hexdig in the request, store_upload then runs on a background worker and the viewer shows a self-refreshing
+# "rendering" page until it's done. If the render fails the upload simply never appears.
+def store_upload(hexdig, data, nfo):
+    render_key = None
+    saved_sfvs = []
+    try:
+        release = data['release']
+        filename = data['filename']
+        save = data['save']
+        date = data.get('date', '')
+        files = data.get('files', '')
+        size = data.get('size', '')
+        sfvs = data.get('sfvs', [])
+
+        render_key = acquire_render(nfo.data, nfo.render_key, nfo.lines)
+
+        # Render SFV files if provided
+        if sfvs:
+            with timed_stage('sfv_loop'):
+                saved_sfvs = save_sfv_files(sfvs)
+
+# Store the release information, the NFO data if save is allowed, and the optional data as one record
+        record = {
+            'render_key': render_key,
+            'release': release,
+            'filename': filename,
+            'save': bool(save),
+            'nfo': nfo.data if save else None,
+            'nfo_gzip': gzip_download(nfo.data) if save else None,
+            'date': date,
+            'files': files,
+            'size': size,
+            'sfvs': saved_sfvs,
+            'render_bytes': storage.render_size(render_key),
+            'deadline': time.time() + timeout_seconds
+        }
+        with timed_stage('store_write'):
+            storage.put_upload(hexdig, record)
+        if not worker_process:
+            index_sfvs(hexdig, saved_sfvs)
+        build_viewer_page(hexdig, record, nfo.lines)
+    except Exception:
+        # Don't leave references behind for an upload that never made it
+        if render_key:
+            release_render(render_key)
+        for sfv in saved_sfvs:
+            release_render(sfv['render_key'])
+        raise
+
+    schedule_expiry(hexdig, record['deadline'])
+    if worker_process:
+        # The master holds the references from here on, a worker only needed them while rendering
+        release_render(render_key)
+        for sfv in saved_sfvs:
+            release_render(sfv['render_key'])
+
+async_executor = ThreadPoolExecutor(max_workers=async_workers, thread_name_prefix='async-upload')
+pending_uploads = {}
+pending_uploads_lock = threading.Lock()
+
+def queue_upload(hexdig, data, nfo):
+    with pending_uploads_lock:
+        if len(pending_uploads) >= async_queue_limit:
+            raise RenderQueueFull(f"{len(pending_uploads)} uploads already waiting to render")
+        pending_uploads[hexdig] = time.time()
+    if worker_process:
+        storage.mark_pending(hexdig)
+    # The copied request context lets the viewer page resolve url_for after this request has gone
+    async_executor.submit(copy_current_request_context(run_queued_upload), hexdig, data, nfo)
+
+def run_queued_upload(hexdig, data, nfo):
+    try:
+        with upload_slot(queue=False):
+            store_upload(hexdig, data, nfo)
+    except Exception:
+        app.logger.exception(f"Async upload {hexdig} failed")
+    finally:
+        with pending_uploads_lock:
+            pending_uploads.pop(hexdig, None)
+        if worker_process:
+            storage.clear_pending(hexdig)
+
+#----------------------
+#-API Stuff
+# Validate and store a single upload payload. Returns the JSON response body and status code, so the single
+# and batch endpoints answer exactly the same way for the same payload. Raw uploads pass the NFO in as a blob
+# instead of base64 nfo_data.
+def process_upload(data, nfo=None):
+    required_fields = ['release', 'filename', 'save']
+    if nfo is None:
+        required_fields.insert(0, 'nfo_data')
+    if not isinstance(data, dict):
+        return {"url": None, "message": "Invalid payload"}, 400
+
+    missing_fields = [field for field in required_fields if field not in data]
+    if missing_fields:
+        return {"url": None, "message": f"Missing fields: {', '.join(missing_fields)}"}, 400
+
+    try:
+        if nfo is None:
+            with timed_stage('base64_decode'):
+                nfo_data = base64.b64decode(data['nfo_data'])
+            nfo = blob_from_bytes(nfo_data)
+        check_render_limits(decode_blob(nfo).lines)
+        if data.get('sfvs'):
+            data = dict(data, sfvs=read_sfv_blobs(data['sfvs']))
+        hexdig = new_upload_hexdig(nfo)
+
+        if data.get('async', async_uploads):
+            queue_upload(hexdig, data, nfo)
+        else:
+            with upload_slot():
+                store_upload(hexdig, data, nfo)
+
+        # Server the web page!
+        return {"url": f"/viewer/{hexdig}", "message": "Success"}, 200
+        
+    except RenderQueueFull:
+        return {"url": None, "message": "Busy"}, 503
+    except UploadRejected as e:
+        return {"url": None, "message": str(e)}, 413
+    except Exception:
+        app.logger.exception("Upload failed")
+        return {"url": None, "message": "Error"}, 500
+
+@app.route('/upload_nfo', methods=['POST'])
+@token_required
+def upload_nfo():
+    if request.mimetype == 'application/octet-stream':
+        data, nfo = read_raw_upload()
+    elif request.mimetype == 'multipart/form-data':
+        data, nfo = read_multipart_upload()
+        if nfo is None:
+            return jsonify({"url": None, "message": "Missing fields: nfo"}), 400
+    else:
+        data, nfo = request.json, None
+    result, status = process_upload(data, nfo)
+    response = jsonify(result)
+    response.status_code = status
+    if status == 503:
+        response.headers['Retry-After'] = str(busy_retry_seconds)
+    return response
+
+# Raw uploads skip JSON and base64 altogether. With application/octet-stream the body is the NFO and the other fields
+# come in as X- headers (no SFVs). With multipart/form-data they're form fields, the NFO is the "nfo" file and every
+# "sfv" file is an SFV named after its filename, with an optional "sfvpath" field per SFV in the same order.
+RAW_UPLOAD_HEADERS = {
+    'release': 'X-Release',
+    'filename': 'X-Filename',
+    'save': 'X-Save',
+    'date': 'X-Date',
+    'files': 'X-Files',
+    'size': 'X-Size',
+    'async': 'X-Async'
+}
+
+def parse_raw_flags(data):
+    for flag in ('save', 'async'):
+        if flag in data:
+            data[flag] = data[flag].strip().lower() in ('1', 'true', 'yes')
+    return data
+
+def read_raw_upload():
+    data = {field: request.headers[header] for field, header in RAW_UPLOAD_HEADERS.items() if header in request.headers}
+    return parse_raw_flags(data), read_upload_stream(request.stream)
+
+def read_multipart_upload():
+    data = {field: request.form[field] for field in RAW_UPLOAD_HEADERS if field in request.form}
+    nfo_file = request.files.get('nfo')
+    nfo = read_upload_stream(nfo_file.stream) if nfo_file is not None else None
+
+    sfvpaths = request.form.getlist('sfvpath')
+    sfvs = []
+    for i, sfv_file in enumerate(request.files.getlist('sfv')):
+        sfvs.append({
+            'sfvname': sfv_file.filename,
+            'sfvpath': sfvpaths[i] if i < len(sfvpaths) else '',
+            'sfv_blob': read_upload_stream(sfv_file.stream)
+        })
+    if sfvs:
+        data['sfvs'] = sfvs
+    return parse_raw_flags(data), nfo
+
+@app.route('/upload_nfo_batch', methods=['POST'])
+@token_required
+def upload_nfo_batch():
+    uploads = request.json
+    if not isinstance(uploads, list) or not uploads:
+        return jsonify({"results": [], "message": "Expected a list of uploads"}), 400
+    if len(uploads) > batch_max_uploads:
+        return jsonify({"results": [], "message": f"Too many uploads, the limit is {batch_max_uploads}"}), 413
+
+    # Each worker gets its own copy of the request context so the viewer page can still resolve url_for
+    futures = [batch_executor.submit(copy_current_request_context(process_upload), upload) for upload in uploads]
+    results = []
+    for future in futures:
+        result, status = future.result()
+        results.append(dict(result, status=status))
+    response = jsonify({"results": results, "message": "Success"})
+    if any(result['status'] == 503 for result in results):
+        response.headers['Retry-After'] = str(busy_retry_seconds)
+    return response
+
+@app.route('/viewer/<filename>')
+def serve_image(filename):
+    page = viewer_page_cache.get(filename)
+    if page is not None and worker_process and not storage.has_upload(filename):
+        # The master expired it, the other workers' caches don't know that
+        viewer_page_cache.pop(filename, None)
+        page = None
+    if page is None and (filename in pending_uploads or (worker_process and storage.is_pending(filename))):
+        response = app.response_class(rendering_template.render(), mimetype='text/html')
+        response.cache_control.no_store = True
+        return response
+    if page is None:
+        record = storage.get_upload(filename)
+        if record is None or not render_exists(record['render_key']):
+            return not_found_template.render(), 404
+        page = build_viewer_page(filename, record)
+        if storage.get_upload(filename) is None:
+            # Expired while we were building it, don't keep it around
+            viewer_page_cache.pop(filename, None)
+
+    # The page is no-cache so browsers revalidate and notice when the hash expires
+    response = app.response_class(page['html'], mimetype='text/html')
+    response.set_etag(page['etag'])
+    response.last_modified = page['last_modified']
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+# Renders are named by hash and never change once they exist, so browsers can keep them for as long as they like and a
+# repeat view is a 304 at most. Downloads are deleted when their upload expires, so they're revalidated every time
+# instead, and only ever kept by the browser. Behind nginx or Apache the file itself can be left to the proxy.
+def offload_enabled():
+    return static_offload is not None and storage.persistent
+
+def offload_file(filename, mimetype, download_name=None):
+    # Hand a file in static/ to the reverse proxy instead of sending it from Python
+    response = app.response_class(mimetype=mimetype)
+    if static_offload == 'x-accel':
+        response.headers['X-Accel-Redirect'] = f"{static_offload_prefix}{filename}"
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(os.path.join(storage.root, filename))
+    if download_name is not None:
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    return response
+
+def cache_forever(response):
+    response.cache_control.public = True
+    response.cache_control.max_age = render_max_age
+    response.cache_control.immutable = True
+    return response
+
+def revalidate_always(response):
+    # A 304 while the upload lives, a 404 once it's gone, and never a copy in a shared cache
+    response.cache_control.public = False
+    response.cache_control.immutable = False
+    response.cache_control.max_age = None
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def send_download(filename, download_name, read):
+    # filename is the artifact in static/, read(gzipped) gets it (or its gzip copy) from the store
+    if offload_enabled():
+        # nginx can send the .gz copies itself with gzip_static on
+        return revalidate_always(offload_file(filename, 'application/octet-stream', download_name))
+    data = read(True) if precompress_downloads and 'gzip' in request.accept_encodings else None
+    gzipped = data is not None
+    if not gzipped:
+        data = read(False)
+    if data is None:
+        return "", 404
+    response = send_file(BytesIO(data), as_attachment=True, download_name=download_name, etag=f"{filename}.gz" if gzipped else filename)
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return revalidate_always(response)
 
 @app.route('/download/<filename>')
 def download_nfo(filename):
 
-    filename_info_path = f"static/{filename}_filename.txt"
-    nfo_path = f'static/{filename}.nfo'
-    if not os.path.exists(nfo_path):
+    record = storage.get_upload(filename)
+    if record is None or not record['save']:
         return "", 404
-    with open(filename_info_path, 'r') as f:
-        original_filename = f.read()
-    return send_file(nfo_path, as_attachment=True, download_name=original_filename)
+    return send_download(f"{filename}.nfo", record['filename'], lambda gzipped: storage.get_nfo(filename, gzipped))
 
 @app.route('/download_sfv/<sfv_hexdig>')
 def download_sfv(sfv_hexdig):
-    # Determine the correct NFO hash by finding the relevant metadata file
-    for root, dirs, files in os.walk('static'):
-        for file in files:
-            if file.endswith('_sfv_metadata.txt'):
-                sfv_metadata_path = os.path.join(root, file)
-                with open(sfv_metadata_path, 'r') as f:
-                    for line in f:
-                        if sfv_hexdig in line:
-                            sfvname = line.split('|')[1]
-                            sfv_data_path = f'static/{sfv_hexdig}.sfv'
-                            if os.path.exists(sfv_data_path):
-                                return send_file(sfv_data_path, as_attachment=True, download_name=sfvname)
-    
-    # If the file doesn't exist or wasn't found, return a 404 error
-    return "", 404
+    # Production workers only know SFVs through the store
+    entry = sfv_index.get(sfv_hexdig) or storage.find_sfv(sfv_hexdig)
+    if entry is None:
+        # If the file doesn't exist or wasn't found, return a 404 error
+        return "", 404
+    hexdig, sfvname, sfvpath = entry
+    return send_download(f"{sfv_hexdig}.sfv", sfvname, lambda gzipped: storage.get_sfv(sfv_hexdig, gzipped))
 
+@app.route('/verify_sfv/<sfv_hexdig>', methods=['POST'])
+@token_required
+def verify_sfv(sfv_hexdig):
+    # Body is {"files": {"<filename>": "<crc32>", ...}}, checked against the SFV in one go
+    files = (request.json or {}).get('files') if isinstance(request.json, dict) else None
+    if not isinstance(files, dict):
+        return jsonify({"message": "Expected files as {filename: crc32}"}), 400
+    entry = sfv_index.get(sfv_hexdig) or storage.find_sfv(sfv_hexdig)
+    sfv_data = storage.get_sfv(sfv_hexdig) if entry is not None else None
+    if sfv_data is None:
+        return jsonify({"message": "Not found"}), 404
+    result = verify_sfv_crcs(parse_sfv(sfv_data)['entries'], files)
+    return jsonify(dict(result, message="Success"))
+
+@app.route('/static/<filename>')
+def serve_render(filename):
+    name, ext = os.path.splitext(filename)
+    render_key, _, strip = name.partition('_')
+    if ext != '.png':
+        return "", 404
+    try:
+        variant = parse_render_variant(request.args) if render_variants else None
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    etag = name if variant is None else f"{name}.{variant_name(variant)}"
+    if request.if_none_match.contains(etag):
+        # The browser already has it and a render never changes, no need to even look
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return cache_forever(response)
+    if variant is None and offload_enabled() and storage.has_render(name):
+        return cache_forever(offload_file(filename, 'image/png'))
+    try:
+        if variant is not None:
+            if strip and not strip.isdigit():
+                return "", 404
+            image_data = get_render_variant(render_key, int(strip) if strip else None, variant)
+        elif strip.isdigit():
+            image_data = get_render_strip(render_key, int(strip))
+        else:
+            image_data = get_render_image(name)
+    except RenderQueueFull:
+        return "", 503, {'Retry-After': str(busy_retry_seconds)}
+    except IndexError:
+        image_data = None
+    if image_data is None:
+        return "", 404
+    return cache_forever(send_file(BytesIO(image_data), mimetype='image/png', etag=etag, max_age=render_max_age))
 
 @app.route('/fonts/<path:filename>')
 def serve_fonts(filename):
-    return send_from_directory('fonts', filename)
+    return send_from_directory('fonts', filename, max_age=asset_max_age)
 
 @app.route('/favicon.ico')
 def favicon():
-    return send_from_directory(app.root_path, 'favicon.ico', mimetype='image/vnd.microsoft.icon')
+    return send_from_directory(app.root_path, 'favicon.ico', mimetype='image/vnd.microsoft.icon', max_age=asset_max_age)
+
+def metric_header(lines, name, kind, description):
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} {kind}")
+
+def format_metrics():
+    artifacts, artifact_bytes, uploads = storage.usage()
+    # Production workers don't hold the expiry queue, but every live upload is waiting to expire
+    expiry_pending = uploads if worker_process else expiry_queue_depth()
+    with metrics_lock:
+        histograms = {stage: dict(histogram, buckets=list(histogram['buckets'])) for stage, histogram in stage_histograms.items()}
+        requests_by_route = dict(route_requests)
+    with render_cache_lock:
+        lookups = dict(render_cache_lookups)
+    with variant_cache_lock:
+        variant_lookups = dict(variant_cache_lookups)
+        variant_bytes = variant_cache_size
+    with token_lock:
+        tokens = {token_id(token): dict(stats) for token, stats in token_stats.items()}
+
+    lines = []
+    metric_header(lines, 'nfodaemon_stage_duration_seconds', 'histogram', 'Time spent in each stage of handling an upload.')
+    for stage, histogram in sorted(histograms.items()):
+        for bound, count in zip(METRIC_BUCKETS, histogram['buckets']):
+            lines.append(f'nfodaemon_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'nfodaemon_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+        lines.append(f'nfodaemon_stage_duration_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+        lines.append(f'nfodaemon_stage_duration_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+
+    metric_header(lines, 'nfodaemon_requests_total', 'counter', 'Requests handled, by route, method and status.')
+    for (route, method, status), count in sorted(requests_by_route.items()):
+        lines.append(f'nfodaemon_requests_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+
+    for name, field, description in (
+        ('nfodaemon_token_requests_total', 'requests', 'Authorized requests, by token hash.'),
+        ('nfodaemon_token_bytes_total', 'bytes', 'Request body bytes, by token hash.'),
+        ('nfodaemon_token_rate_limited_total', 'limited', 'Requests turned away by the token rate limit, by token hash.'),
+    ):
+        metric_header(lines, name, 'counter', description)
+        for token, stats in sorted(tokens.items()):
+            lines.append(f'{name}{{token="{token}"}} {stats[field]}')
+
+    metric_header(lines, 'nfodaemon_render_cache_lookups_total', 'counter', 'Render cache lookups, by whether the render was already there.')
+    for result in ('hit', 'miss'):
+        lines.append(f'nfodaemon_render_cache_lookups_total{{result="{result}"}} {lookups[result]}')
+    metric_header(lines, 'nfodaemon_render_cache_hit_ratio', 'gauge', 'Share of render cache lookups that were hits.')
+    total_lookups = lookups['hit'] + lookups['miss']
+    lines.append(f"nfodaemon_render_cache_hit_ratio {lookups['hit'] / total_lookups if total_lookups else 0}")
+    metric_header(lines, 'nfodaemon_variant_cache_lookups_total', 'counter', 'Render variant cache lookups, by whether the variant was already there.')
+    for result in ('hit', 'miss'):
+        lines.append(f'nfodaemon_variant_cache_lookups_total{{result="{result}"}} {variant_lookups[result]}')
+
+    for name, description, value in (
+        ('nfodaemon_artifacts', 'Files (or in memory entries) held by the artifact store.', artifacts),
+        ('nfodaemon_artifact_bytes', 'Bytes held by the artifact store.', artifact_bytes),
+        ('nfodaemon_uploads', 'Uploads currently viewable.', uploads),
+        ('nfodaemon_expiry_pending', 'Uploads waiting to expire.', expiry_pending),
+        ('nfodaemon_variant_cache_bytes', 'Bytes of render variants held in memory.', variant_bytes),
+        ('nfodaemon_render_queue_depth', 'Renders queued for the render processes.', render_queue_depth()),
+        ('nfodaemon_async_uploads_pending', 'Async uploads waiting to render.', len(pending_uploads)),
+        ('nfodaemon_uploads_rendering', 'Uploads holding a render slot.', upload_slots.running),
+        ('nfodaemon_uploads_waiting', 'Uploads waiting for a render slot.', upload_slots.waiting),
+        ('nfodaemon_view_renders_running', 'Viewer renders holding a render slot.', view_render_slots.running),
+        ('nfodaemon_view_renders_waiting', 'Viewer renders waiting for a render slot.', view_render_slots.waiting),
+    ):
+        metric_header(lines, name, 'gauge', description)
+        lines.append(f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics')
+@token_required
+def metrics():
+    return app.response_class(format_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
 #-End of API stuff
 #----------------------
 
-# Cleanup files after NFO timeout.
-# NOTE if you were to kill the process before this cleanup occurs, the files will remain in static.
-# I use this as a way of easily testing without having to send new NFO data
-def remove_file_after_delay(image_path, release_info_path, nfo_data_path, filename_info_path, saved_sfv_paths, delay):
-    time.sleep(delay)
-    if os.path.exists(image_path):
-        os.remove(image_path)
-    if os.path.exists(release_info_path):
-        os.remove(release_info_path)
-    if nfo_data_path and os.path.exists(nfo_data_path):
-        os.remove(nfo_data_path)
-    if filename_info_path and os.path.exists(filename_info_path):
-        os.remove(filename_info_path)
-    optional_fields_path = f"{os.path.splitext(image_path)[0]}_optional.txt"
-    sfv_metadata_path = f"{os.path.splitext(image_path)[0]}_sfv_metadata.txt"
-    if os.path.exists(optional_fields_path):
-        os.remove(optional_fields_path)
-    if os.path.exists(sfv_metadata_path):
-        os.remove(sfv_metadata_path)
-    for sfv in saved_sfv_paths:
-        if os.path.exists(sfv['sfv_data_path']):
-            os.remove(sfv['sfv_data_path'])
-        if os.path.exists(sfv['sfv_image_path']):
-            os.remove(sfv['sfv_image_path'])
+#----------------------
+#-Expiry scheduler
+# One thread works through a heap of (deadline, hexdig) instead of starting a sleeping thread per upload, so memory
+# stays flat however big the burst is. Every upload's deadline is in its upload index entry, so pending deletions
+# survive a restart, and anything in static/ that no upload owns gets swept at startup.
+# In production mode only the master process expires anything: the workers add uploads to the index and the master
+# follows it, so there is exactly one set of render references no matter which worker took the upload.
+expiry_heap = []
+expiry_condition = threading.Condition()
+
+def expiry_queue_depth():
+    with expiry_condition:
+        return len(expiry_heap)
+
+def schedule_expiry(hexdig, deadline):
+    # The master picks up worker uploads from the index instead
+    if worker_process:
+        return
+    with expiry_condition:
+        heapq.heappush(expiry_heap, (deadline, hexdig))
+        expiry_condition.notify()
+
+def retain_upload_renders(record):
+    # Give a recovered or followed upload its references on the renders it uses
+    render_keys = [record['render_key']] + [sfv['render_key'] for sfv in record['sfvs'] if sfv['render_key']]
+    for key in render_keys:
+        entry, owner = reserve_render(key)
+        entry['ready'].set()
+    return render_keys
+
+def follow_upload_index():
+    # Caller holds expiry_condition. Pick up what the workers stored since we last looked
+    for hexdig, record in storage.refresh():
+        retain_upload_renders(record)
+        heapq.heappush(expiry_heap, (record['deadline'] or 0, hexdig))
+
+def expire_upload(hexdig):
+    record = storage.get_upload(hexdig)
+    if record is None:
+        return
+    unindex_sfvs(record['sfvs'])
+    storage.delete_upload(hexdig)
+    viewer_page_cache.pop(hexdig, None)
+    release_render(record['render_key'])
+    for sfv in record['sfvs']:
+        release_render(sfv['render_key'])
+
+def run_expiry_scheduler():
+    # When following the index, look for new uploads at least once a second
+    poll = 1 if server_mode == 'production' and storage.persistent else None
+    while True:
+        with expiry_condition:
+            while True:
+                if poll is not None:
+                    follow_upload_index()
+                if expiry_heap and expiry_heap[0][0] <= time.time():
+                    break
+                wait = expiry_heap[0][0] - time.time() if expiry_heap else None
+                if poll is not None:
+                    wait = poll if wait is None else min(wait, poll)
+                expiry_condition.wait(wait)
+            deadline, hexdig = heapq.heappop(expiry_heap)
+        try:
+            expire_upload(hexdig)
+        except Exception:
+            app.logger.exception(f"Expiring {hexdig} failed, trying again in {expiry_retry_seconds}s")
+            schedule_expiry(hexdig, time.time() + expiry_retry_seconds)
+            continue
+        try:
+            storage.compact()
+        except Exception:
+            app.logger.exception("Compacting the upload index failed")
+
+def recover_expiry_queue():
+    # Re-register uploads that were still pending when we last stopped. Live uploads hold references on their
+    # renders again, so expiring them cleans up shared PNGs properly
+    uploads = storage.load()
+    live = set(uploads)
+    for hexdig, record in uploads.items():
+        live.update(retain_upload_renders(record))
+        live.update(sfv['sfv_hexdig'] for sfv in record['sfvs'])
+        index_sfvs(hexdig, record['sfvs'])
+
+    with expiry_condition:
+        expiry_heap[:] = [(record['deadline'] or 0, hexdig) for hexdig, record in uploads.items()]
+        heapq.heapify(expiry_heap)
+    storage.compact(force=True)
+    return live
+
+def sweep_static(live, before):
+    # Runs in the background once the daemon is up. Anything left over from before we started that no upload owns
+    # is deleted. Renders picked up by new uploads while we were sweeping are in the render cache
+    keep = (os.path.basename(UPLOAD_INDEX), os.path.basename(UPLOAD_INDEX_LOCK))
+    storage.sweep(lambda owner: owner in live or owner in render_cache, keep=keep, before=before)
 
 #### New stuff to handle bot scans
 @app.before_request
@@ -603,6 +2855,142 @@ def page_not_found(e):
         
 
 
+#----------------------
+#-Serving
+# create_app starts the background work (expiry recovery and the scheduler) once per process that owns it. In
+# production mode that's the gunicorn master: it never serves requests itself, the forked workers do.
+background_tasks_started = False
+
+def prewarm():
+    # Load and check the render font, then put a tiny NFO through the renderer and every template, so the first
+    # real request doesn't pay for any of it. In production this happens in the master and the workers inherit it
+    try:
+        get_render_font(font_path, font_size)
+    except OSError as e:
+        raise SystemExit(f"Can't load the render font {font_path}: {e}")
+    if use_glyph_atlas and get_glyph_atlas(font_path, font_size) is None:
+        app.logger.warning(f"{font_path} can't be used for the glyph atlas, rendering with FreeType")
+    if render_variants:
+        for name, (variant_path, variant_size) in variant_fonts.items():
+            try:
+                get_render_font(variant_path, variant_size)
+            except OSError as e:
+                raise SystemExit(f"Can't load the {name} variant font {variant_path}: {e}")
+            if use_glyph_atlas:
+                get_glyph_atlas(variant_path, variant_size)
+    sample = 'SPRE ░▒▓█\r\n'.encode('cp437')
+    render_png_timed(read_nfo_from_bytes(sample))
+    with app.test_request_context():
+        build_viewer_page('0' * 32, {
+            'render_key': render_cache_key(sample),
+            'release': 'SPRE',
+            'filename': 'spre.nfo',
+            'save': True,
+            'date': '',
+            'files': '',
+            'size': '',
+            'sfvs': []
+        })
+        viewer_page_cache.pop('0' * 32, None)
+        not_found_template.render()
+        rendering_template.render()
+
+def create_app():
+    global background_tasks_started
+    if not background_tasks_started:
+        background_tasks_started = True
+        started = time.time()
+        live = recover_expiry_queue()
+        prewarm()
+        threading.Thread(target=run_expiry_scheduler, name='expiry-scheduler', daemon=True).start()
+        if sweep_orphans_on_startup:
+            threading.Thread(target=sweep_static, args=(live, started), name='static-sweep', daemon=True).start()
+        start_token_watcher()
+        # Under gunicorn the master's SIGHUP handling takes over from this, see reload_worker_tokens
+        if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, reload_tokens_on_signal)
+    return app
+
+def reset_locks_after_fork():
+    # The master is already running the expiry, sweep and token threads when gunicorn forks a worker, at boot and
+    # whenever a worker is restarted. A lock one of them held at that moment would stay held in the worker for good,
+    # so every worker starts out with fresh ones
+    global token_lock, metrics_lock, render_jobs_lock, render_cache_lock, variant_cache_lock, sfv_index_lock
+    global pending_uploads_lock, expiry_condition
+    token_lock = threading.Lock()
+    metrics_lock = threading.Lock()
+    render_jobs_lock = threading.Lock()
+    render_cache_lock = threading.Lock()
+    variant_cache_lock = threading.Lock()
+    sfv_index_lock = threading.Lock()
+    pending_uploads_lock = threading.Lock()
+    expiry_condition = threading.Condition()
+    upload_slots.condition = threading.Condition()
+    view_render_slots.condition = threading.Condition()
+    storage.lock = threading.Lock()
+
+def clear_caches_after_fork():
+    # Whatever the master had cached (recovered renders, tombstones, pages for uploads it has since expired) is only
+    # right for the master. Workers find uploads and renders through the store, so they start with nothing
+    global variant_cache_size
+    render_cache.clear()
+    sfv_index.clear()
+    viewer_page_cache.clear()
+    variant_cache.clear()
+    variant_cache_size = 0
+    pending_uploads.clear()
+
+def mark_worker_process(server, worker):
+    global worker_process
+    worker_process = True
+    reset_locks_after_fork()
+    clear_caches_after_fork()
+    # Threads don't survive the fork, each worker watches tokens.txt itself
+    start_token_watcher()
+
+def reload_worker_tokens(server):
+    # gunicorn restarts the workers on SIGHUP, reload first so the new ones are forked with the new tokens
+    load_tokens()
+
+def run_production_server():
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("server_mode = 'production' needs gunicorn, install it with: pip install gunicorn")
+
+    if storage_backend != 'filesystem':
+        raise SystemExit("server_mode = 'production' shares uploads between worker processes, use storage_backend = 'filesystem'")
+
+    class DaemonServer(BaseApplication):
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    options = {
+        'bind': f"{host_ip}:{server_port}",
+        'workers': server_workers,
+        'threads': server_threads,
+        'worker_class': 'gthread',
+        'keepalive': server_keepalive,
+        'certfile': le_fullchain,  # lets encrypt certs for ssl
+        'keyfile': le_privkey,
+        'post_fork': mark_worker_process,
+        'on_reload': reload_worker_tokens,
+    }
+    DaemonServer(create_app(), options).run()
+
 if __name__ == '__main__':
-    context = (le_fullchain, le_privkey)  # lets encrypt certs for ssl
-    app.run(debug=debug_mode, port=server_port, host=host_ip, ssl_context=context, use_reloader=False)
+    if server_mode == 'production':
+        run_production_server()
+    else:
+        create_app()
+        context = (le_fullchain, le_privkey)  # lets encrypt certs for ssl
+        app.run(debug=debug_mode, port=server_port, host=host_ip, ssl_context=context, use_reloader=False)
@@ -0,0 +1,36 @@
+# Run from the repository root: python -m pytest tests
+import numpy as np
+import pytest
+
+import main
+
+# Every CP437 glyph except the line breaks, plus lines of different lengths so the padding gets drawn too
+ALL_GLYPHS = bytes(code for code in range(256) if code not in (10, 13))
+NFO = b'\r\n'.join([ALL_GLYPHS[:128], ALL_GLYPHS[128:], b'', b'  \xdb\xdb\xb2\xb1\xb0 Release-GRP', b'\xc9' + b'\xcd' * 40 + b'\xbb'])
+
+def pixels(image):
+    return np.asarray(image.convert('RGB'))
+
+def test_the_atlas_draws_exactly_what_freetype_does():
+    style = main.render_style()
+    atlas = main.get_glyph_atlas(style['font_path'], style['font_size'])
+    if atlas is None:
+        pytest.skip(f"{style['font_path']} can't be used for the glyph atlas")
+    lines = main.read_nfo_from_bytes(NFO)
+    assert np.array_equal(pixels(main.render_nfo_with_atlas(lines, atlas, style)), pixels(main.render_nfo_with_freetype(lines, style)))
+
+@pytest.mark.parametrize('use_glyph_atlas', [True, False])
+def test_stacked_strips_are_the_full_image(monkeypatch, use_glyph_atlas):
+    monkeypatch.setattr(main, 'use_glyph_atlas', use_glyph_atlas)
+    monkeypatch.setattr(main, 'tile_lines', 4)
+    # 11 lines is two full strips and a short one, with the widest line in the middle strip
+    rows = [b'\xdb' * (index * 7 % 23) + b' line %d' % index for index in range(11)]
+    lines = main.read_nfo_from_bytes(b'\r\n'.join(rows))
+
+    full = main.render_nfo_to_image(lines)
+    layout = main.nfo_tile_layout(lines)
+    strips = [main.render_nfo_strip(lines, index) for index in range(len(layout))]
+    assert [strip.size for strip in strips] == layout
+    assert np.array_equal(np.vstack([pixels(strip) for strip in strips]), pixels(full))
+    with pytest.raises(IndexError):
+        main.render_nfo_strip(lines, len(layout))
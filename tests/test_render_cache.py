@@ -0,0 +1,60 @@
+# Run from the repository root: python -m pytest tests
+import threading
+
+import pytest
+
+import main
+
+NFO = 'Same.Release-GRP ░▒▓█\r\n'.encode('cp437')
+
+@pytest.fixture
+def store(monkeypatch):
+    store = main.MemoryStore(1 << 30)
+    monkeypatch.setattr(main, 'storage', store)
+    monkeypatch.setattr(main, 'render_cache', {})
+    monkeypatch.setattr(main, 'render_processes', 0)
+    return store
+
+def test_duplicates_keep_the_render_until_the_last_release(store):
+    first = main.acquire_render(NFO)
+    second = main.acquire_render(NFO)
+    third = main.acquire_render(NFO)
+    assert first == second == third
+    assert main.render_cache[first]['refs'] == 3
+
+    # Uploads expire in whatever order their deadlines come up, not the order they took their references
+    main.release_render(second)
+    main.release_render(first)
+    assert store.has_render(first)
+    main.release_render(third)
+    assert not store.has_render(first)
+    assert first not in main.render_cache
+
+def test_a_reupload_waits_for_the_release_in_progress(store, monkeypatch):
+    key = main.acquire_render(NFO)
+    deleting = threading.Event()
+    proceed = threading.Event()
+    delete_render_unless_claimed = store.delete_render_unless_claimed
+
+    def slow_delete(key, delete):
+        deleting.set()
+        proceed.wait(5)
+        return delete_render_unless_claimed(key, delete)
+    monkeypatch.setattr(store, 'delete_render_unless_claimed', slow_delete)
+
+    release = threading.Thread(target=main.release_render, args=(key,))
+    release.start()
+    assert deleting.wait(5)
+    reuploaded = []
+    reupload = threading.Thread(target=lambda: reuploaded.append(main.acquire_render(NFO)))
+    reupload.start()
+    # The old files are still being deleted, the re-upload mustn't take them over
+    reupload.join(0.2)
+    assert reupload.is_alive()
+
+    proceed.set()
+    release.join(5)
+    reupload.join(5)
+    assert reuploaded == [key]
+    assert store.has_render(key)
+    assert main.render_cache[key]['refs'] == 1
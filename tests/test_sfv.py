@@ -0,0 +1,62 @@
+# Run from the repository root: python -m pytest tests
+import main
+
+SFV = b'\r\n'.join([
+    b'',
+    b'; Generated by WIN-SFV32',
+    b';  \xdb\xdb\xb2 Release-GRP \xb2\xdb\xdb',
+    b'',
+    b'release.r00 1a2b3c4d',
+    b'release.r01 deadbeef',
+    b'Sub\\release.subs.rar 00000000',
+    b'file with spaces.nfo CAFEF00D',
+    b'; release.r02 12345678',
+    b'not an entry 1234567',
+    b'',
+])
+
+def test_parse_sfv_splits_entries_from_art():
+    parsed = main.parse_sfv(SFV)
+    assert parsed['entries'] == [
+        {'filename': 'release.r00', 'crc': '1A2B3C4D'},
+        {'filename': 'release.r01', 'crc': 'DEADBEEF'},
+        {'filename': 'Sub\\release.subs.rar', 'crc': '00000000'},
+        {'filename': 'file with spaces.nfo', 'crc': 'CAFEF00D'},
+    ]
+    # Commented out entries and anything that isn't quite a CRC stay with the art, blank lines only inside it
+    assert parsed['comments'] == [
+        b'; Generated by WIN-SFV32',
+        b';  \xdb\xdb\xb2 Release-GRP \xb2\xdb\xdb',
+        b'',
+        b'; release.r02 12345678',
+        b'not an entry 1234567',
+    ]
+
+def test_sfv_art_is_only_the_comments(monkeypatch):
+    monkeypatch.setattr(main, 'sfv_render_mode', 'table')
+    assert main.sfv_art(SFV) == b'\r\n'.join(main.parse_sfv(SFV)['comments']) + b'\r\n'
+    assert main.sfv_art(b'release.r00 1a2b3c4d\r\n') is None
+    monkeypatch.setattr(main, 'sfv_render_mode', 'image')
+    assert main.sfv_art(SFV) == SFV
+
+def test_verify_sfv_crcs():
+    entries = main.parse_sfv(SFV)['entries']
+    result = main.verify_sfv_crcs(entries, {
+        'RELEASE.R00': '1a2b3c4d',
+        'release.r01': 0xDEADBEE0,
+        'sub/release.subs.rar': 0,
+        'file with spaces.nfo': 'not a crc',
+        'release.r99': '12345678',
+    })
+    assert result['ok'] == ['RELEASE.R00', 'sub/release.subs.rar']
+    assert result['bad'] == [
+        {'filename': 'release.r01', 'expected': 'DEADBEEF', 'got': 'DEADBEE0'},
+        {'filename': 'file with spaces.nfo', 'expected': 'CAFEF00D', 'got': 'not a crc'},
+    ]
+    assert result['missing'] == []
+    assert result['unknown'] == ['release.r99']
+
+def test_verify_sfv_crcs_reports_what_wasnt_supplied():
+    entries = main.parse_sfv(SFV)['entries']
+    result = main.verify_sfv_crcs(entries, {})
+    assert result == {'ok': [], 'bad': [], 'missing': [entry['filename'] for entry in entries], 'unknown': []}
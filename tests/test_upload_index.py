@@ -0,0 +1,78 @@
+# Run from the repository root: python -m pytest tests
+import os
+import time
+
+import main
+
+def make_record(release):
+    return {
+        'render_key': 'a' * 64,
+        'release': release,
+        'filename': 'release.nfo',
+        'save': True,
+        'nfo': b'nfo',
+        'nfo_gzip': None,
+        'date': '',
+        'files': '',
+        'size': '',
+        'sfvs': [],
+        'render_bytes': 0,
+        'deadline': time.time() + 300
+    }
+
+def test_refresh_hands_over_uploads_another_lookup_read_first(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('static')
+    worker = main.FilesystemStore('static', shared=True)
+    master = main.FilesystemStore('static', shared=True)
+    master.load()
+
+    hexdig = '1' * 32
+    worker.put_upload(hexdig, make_record('Worker.Upload-GRP'))
+    # A lookup (expiry, a viewer hit) reads the worker's line before the master follows the index
+    assert master.get_upload(hexdig)['release'] == 'Worker.Upload-GRP'
+    assert [added for added, record in master.refresh()] == [hexdig]
+    assert master.refresh() == []
+
+def test_refresh_skips_uploads_deleted_before_it_runs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('static')
+    worker = main.FilesystemStore('static', shared=True)
+    master = main.FilesystemStore('static', shared=True)
+    master.load()
+
+    hexdig = '2' * 32
+    worker.put_upload(hexdig, make_record('Gone.Already-GRP'))
+    worker.delete_upload(hexdig)
+    assert master.get_upload(hexdig) is None
+    assert master.refresh() == []
+
+def test_master_keeps_a_render_a_worker_has_claimed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('static')
+    worker = main.FilesystemStore('static', shared=True)
+    master = main.FilesystemStore('static', shared=True)
+    master.load()
+    deleted = []
+
+    key = 'a' * 64
+    assert worker.claim_render(key, lambda: True)
+    assert not master.delete_render_unless_claimed(key, lambda: deleted.append(key))
+    # The worker's upload uses up the claim, and then the upload itself holds on to the render
+    hexdig = '3' * 32
+    worker.put_upload(hexdig, make_record('Claimed-GRP'))
+    assert not master.delete_render_unless_claimed(key, lambda: deleted.append(key))
+    worker.delete_upload(hexdig)
+    assert master.delete_render_unless_claimed(key, lambda: deleted.append(key))
+    assert deleted == [key]
+
+def test_a_claim_fails_once_the_render_is_gone(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('static')
+    worker = main.FilesystemStore('static', shared=True)
+    master = main.FilesystemStore('static', shared=True)
+    master.load()
+
+    key = 'b' * 64
+    assert not worker.claim_render(key, lambda: False)
+    assert master.delete_render_unless_claimed(key, lambda: None)